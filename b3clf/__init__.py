@@ -28,4 +28,4 @@ try:
 except ImportError:
     __version__ = "0.0.0.post0"
 
-from .b3clf import b3clf
+from .b3clf import b3clf, b3clf_async
@@ -23,8 +23,10 @@
 
 """Package for BBB predictions."""
 import argparse
+import sys
 
 from .b3clf import b3clf
+from .tuning import CONFIG_FNAME, tune
 
 try:
     from .version import __version__
@@ -32,7 +34,84 @@ except ImportError:
     __version__ = "0.0.0.post0"
 
 
-def main():
+def tune_main(argv):
+    """Command-line interface of `b3clf tune`."""
+    parser = argparse.ArgumentParser(
+        prog="b3clf tune",
+        description="Time the B3clf stages on a sample of the input and write a recommended "
+                    "configuration which b3clf loads automatically.",
+    )
+    parser.add_argument("-mol",
+                        default="input.sdf",
+                        type=str,
+                        help="Input file the configuration is tuned for.")
+    parser.add_argument("-sep",
+                        type=str,
+                        default="\s+|\t+",
+                        help="""Separator for input file. Default="\s+|\\t+".""")
+    parser.add_argument("-clf",
+                        type=str,
+                        default="xgb",
+                        help="Classification algorithm type. Default=xgb.")
+    parser.add_argument("-sampling",
+                        type=str,
+                        default="classic_ADASYN",
+                        help="Resampling method type. Default=classic_ADASYN.")
+    parser.add_argument("-n_sample",
+                        type=int,
+                        default=50,
+                        help="Number of molecules used for calibration. Default=50.")
+    parser.add_argument("-n_cpus",
+                        type=int,
+                        default=None,
+                        help="""CPU budget to tune for. Default=None, which uses the CPUs """
+                             """available to the process.""")
+    parser.add_argument("-target_chunk_seconds",
+                        type=float,
+                        default=60.0,
+                        help="Approximate geometry optimization time per chunk. Default=60.")
+    parser.add_argument("-time_per_mol",
+                        type=int,
+                        default=-1,
+                        help="""PaDEL time per molecule in seconds, as used for the runs being """
+                             """tuned for. If set to be -1, no time limit. Default=-1.""")
+    parser.add_argument("-optimizer",
+                        type=str,
+                        default="default",
+                        help="""Geometry optimizer of the runs being tuned for, "default", """
+                             """"adaptive" or "screening". Default=default.""")
+    parser.add_argument("-energy_tol",
+                        type=float,
+                        default=None,
+                        help="""Energy tolerance of the adaptive optimizers. Default=None.""")
+    parser.add_argument("-output",
+                        type=str,
+                        default=CONFIG_FNAME,
+                        help=f"Configuration file to write. Default={CONFIG_FNAME}.")
+    args = parser.parse_args(argv)
+
+    config = tune(mol_in=args.mol,
+                  sep=args.sep,
+                  clf=args.clf,
+                  sampling=args.sampling,
+                  n_sample=args.n_sample,
+                  n_cpus=args.n_cpus,
+                  target_chunk_seconds=args.target_chunk_seconds,
+                  time_per_mol=args.time_per_mol,
+                  optimizer=args.optimizer,
+                  energy_tol=args.energy_tol,
+                  output=args.output,
+                  )
+    for key, value in config.items():
+        print(f"{key}: {value}")
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) > 0 and argv[0] == "tune":
+        return tune_main(argv[1:])
+
     # https://docs.python.org/3/library/argparse.html
     parser = argparse.ArgumentParser(
         description="b3clf predicts if molecules can pass blood-brain barrier with resampling "
@@ -88,7 +167,79 @@ def main():
                              """"J_threshold" and "F_threshold". "J_threshold" will use """
                              """threshold optimized from Youden’s J statistic. "F_threshold" will """
                              """use threshold optimized from F score. Default="none".""")
-    args = parser.parse_args()
+    parser.add_argument("-chunk_size",
+                        type=int,
+                        default=None,
+                        help="""Number of molecules per chunk. When set, geometry optimization, """
+                             """descriptor calculation and prediction run concurrently on """
+                             """successive chunks. Default=None.""")
+    parser.add_argument("-n_cpus",
+                        type=int,
+                        default=None,
+                        help="""Number of CPUs to use across all stages. Default=None, which uses """
+                             """the CPUs available to the process, honouring cgroup limits.""")
+    parser.add_argument("-geometry_workers",
+                        type=int,
+                        default=None,
+                        help="""Number of geometry optimization processes when -chunk_size is """
+                             """set. Default=None, which uses half of the CPUs.""")
+    parser.add_argument("-descriptor_workers",
+                        type=int,
+                        default=None,
+                        help="""Number of concurrent PaDEL runs when -chunk_size is set. """
+                             """Default=None, which uses one.""")
+    parser.add_argument("-triage",
+                        type=str,
+                        default="no",
+                        help="""To short-circuit confidently classified molecules with a cheap 2D """
+                             """surrogate ("yes") or not ("no"). Default=no.""")
+    parser.add_argument("-triage_model",
+                        type=str,
+                        default=None,
+                        help="""Joblib file of a calibrated triage surrogate. Default=None, which """
+                             """uses the built-in rules.""")
+    parser.add_argument("-triage_band",
+                        type=float,
+                        nargs=2,
+                        default=[0.05, 0.95],
+                        help="""Lower and upper surrogate probability of the uncertain band. """
+                             """Only has an effect with -triage_model, the built-in rules """
+                             """score 0 or 0.5. Default=0.05 0.95.""")
+    parser.add_argument("-explain",
+                        type=str,
+                        default="no",
+                        help="""To add the top contributing PaDEL descriptors of each prediction """
+                             """("yes") or not ("no"). Default=no.""")
+    parser.add_argument("-top_k",
+                        type=int,
+                        default=5,
+                        help="""Number of descriptors reported per molecule with -explain yes. """
+                             """Default=5.""")
+    parser.add_argument("-optimizer",
+                        type=str,
+                        default="default",
+                        help="""Geometry optimizer which can be "default", "adaptive" or """
+                             """"screening". The adaptive optimizers report energy, iterations and """
+                             """convergence status per molecule. Default=default.""")
+    parser.add_argument("-energy_tol",
+                        type=float,
+                        default=None,
+                        help="""Relative energy change per iteration stopping the adaptive """
+                             """optimizers. Default=None, which uses 1e-6 for "adaptive" and """
+                             """1e-4 for "screening".""")
+    parser.add_argument("-config",
+                        type=str,
+                        default=None,
+                        help="""Configuration file written by "b3clf tune". Default=None, which """
+                             """uses $B3CLF_CONFIG, ./b3clf_config.json or ~/.b3clf/config.json """
+                             """if present.""")
+    parser.add_argument("-delta_state",
+                        type=str,
+                        default=None,
+                        help="""State file for incremental delta scoring; only new or changed """
+                             """molecules are computed and merged with the stored results. """
+                             """Created on the first run. Default=None.""")
+    args = parser.parse_args(argv)
 
     _ = b3clf(mol_in=args.mol,
               sep=args.sep,
@@ -101,6 +252,19 @@ def main():
               keep_features=args.keep_features,
               keep_sdf=args.keep_sdf,
               threshold=args.threshold,
+              chunk_size=args.chunk_size,
+              n_cpus=args.n_cpus,
+              n_geometry_workers=args.geometry_workers,
+              n_descriptor_workers=args.descriptor_workers,
+              triage=args.triage == "yes",
+              triage_model=args.triage_model,
+              triage_band=tuple(args.triage_band),
+              explain=args.explain == "yes",
+              top_k=args.top_k,
+              optimizer=args.optimizer,
+              energy_tol=args.energy_tol,
+              config=args.config,
+              delta_state=args.delta_state,
               )
 
 
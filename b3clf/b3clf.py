@@ -26,20 +26,30 @@ Main B3clf Script.
 """
 
 # Todo: Enable b3clf prediction without PaDeL calculation from PaDeL descriptor input
+import asyncio
+import functools
 import os
 
 import numpy as np
+import pandas as pd
+from .delta import run_delta
 from .descriptor_padel import compute_descriptors
-from .geometry_opt import geometry_optimize
+from .explain import check_explain
+from .geometry_opt import add_geometry_report, geometry_optimize
+from .pipeline import run_pipeline
+from .resources import plan_resources
+from .triage import triage_molecules
+from .tuning import load_config
 from .utils import (
-    get_descriptors,
+    get_feature_matrix,
+    get_threshold,
     predict_permeability,
     scale_descriptors,
-    select_descriptors,
 )
 
 __all__ = [
     "b3clf",
+    "b3clf_async",
 ]
 
 
@@ -55,6 +65,19 @@ def b3clf(
     keep_features="no",
     keep_sdf="no",
     threshold="none",
+    chunk_size=None,
+    n_cpus=None,
+    n_geometry_workers=None,
+    n_descriptor_workers=None,
+    triage=False,
+    triage_model=None,
+    triage_band=(0.05, 0.95),
+    explain=False,
+    top_k=5,
+    optimizer="default",
+    energy_tol=None,
+    config=None,
+    delta_state=None,
 ):
     """Use B3clf for BBB classifications with resampling strategies.
 
@@ -92,6 +115,60 @@ def b3clf(
         To set the threshold for the predicted probability which can be "none". "J_threshold" and
         "F_threshold". "J_threshold" will use threshold optimized from Youden’s J statistic.
         "F_threshold" will use threshold optimized from F score. Default="none".
+    chunk_size : int, optional
+        When set, molecules are processed in chunks of this size and geometry optimization,
+        descriptor calculation and prediction run concurrently on successive chunks.
+        Default=None, which runs the stages one after another on the whole input.
+    n_cpus : int, optional
+        Number of CPUs B3clf may use, split between geometry optimization, PaDEL and prediction.
+        Default=None, which uses the CPUs available to the process, honouring cgroup limits.
+    n_geometry_workers : int, optional
+        Number of worker processes for geometry optimization when `chunk_size` is set.
+        Default=None, which uses half of `n_cpus`.
+    n_descriptor_workers : int, optional
+        Number of concurrent PaDEL runs when `chunk_size` is set. Default=None, which uses one.
+    triage : bool, optional
+        When True, molecules are first scored from cheap RDKit 2D descriptors and only those
+        inside the confidence band go through geometry optimization and PaDEL. Default=False.
+    triage_model : str, optional
+        Joblib file of a surrogate calibrated with `b3clf.triage.calibrate_triage`, which is also
+        the only way to estimate the speedup and the agreement with the full B3clf labels; they
+        are not reported here. Default=None, which only short-circuits molecules far outside the
+        CNS property space.
+    triage_band : tuple of float, optional
+        Molecules with a surrogate BBB+ probability strictly between the two values are sent
+        through the full workflow. The built-in rules only score 0 or 0.5, so the band only has
+        an effect with a calibrated `triage_model`. Short-circuited molecules are labelled with `threshold` and
+        their surrogate probability is reported as "B3clf_triage_probability", while their
+        "B3clf_predicted_probability" is left empty. Default=(0.05, 0.95).
+    explain : bool, optional
+        When True, the `top_k` PaDEL descriptors contributing most to each prediction and their
+        contributions are added to the output. Not available for "knn", which is rejected before
+        any work starts. Default=False.
+    top_k : int, optional
+        Number of descriptors reported per molecule when `explain` is True, at least 1.
+        Default=5.
+    optimizer : str, optional
+        Geometry optimizer, "default", "adaptive" or "screening". The adaptive optimizers run a
+        single minimization per molecule, "screening" with looser convergence criteria, and add
+        the final energy, iterations used and convergence status to the output. Molecules that
+        cannot be embedded skip PaDEL and are reported with the status "embedding_failed" and an
+        empty probability and label. Default="default".
+    energy_tol : float, optional
+        Relative energy change per iteration stopping the adaptive optimizers. Default=None,
+        which uses 1e-6 for "adaptive" and 1e-4 for "screening".
+    config : str, optional
+        JSON configuration written by `b3clf tune`, providing `chunk_size`, `n_cpus`,
+        `n_geometry_workers` and `n_descriptor_workers` when they are not given. Default=None,
+        which looks for the file given by the B3CLF_CONFIG environment variable,
+        ./b3clf_config.json or ~/.b3clf/config.json.
+    delta_state : str, optional
+        State file for incremental delta scoring. Only molecules that are new or changed (by ID
+        and canonical structure) since the run that wrote the state are computed, and the
+        results are merged with the stored ones. If only the model, scaler or threshold
+        artifacts changed, stored descriptors are re-predicted without geometry optimization
+        or PaDEL. The file is created on the first run. Chunking is not used in delta mode and
+        it cannot be combined with `triage`. Default=None.
 
     Returns
     -------
@@ -109,41 +186,145 @@ def b3clf(
     features_out = f"{mol_tag}_padel_descriptors.xlsx"
     internal_sdf = f"{mol_tag}_optimized_3d.sdf"
 
-    # Geometry optimization
-    # Input:
-    # * Either an SDF file with molecular geometries or a text file with SMILES strings
+    if delta_state is not None and triage:
+        raise ValueError("Delta scoring cannot be combined with triage.")
+    if explain:
+        # fail before any geometry optimization or PaDEL run
+        check_explain(clf_str=clf, top_k=top_k)
 
-    geometry_optimize(input_fname=mol_in, output_sdf=internal_sdf, sep=sep)
+    # fill in the settings not given explicitly from the tuned configuration
+    settings = load_config(config)
+    if chunk_size is None:
+        chunk_size = settings.get("chunk_size")
+    if n_cpus is None:
+        n_cpus = settings.get("n_cpus")
+    if n_geometry_workers is None:
+        n_geometry_workers = settings.get("n_geometry_workers")
+    if n_descriptor_workers is None:
+        n_descriptor_workers = settings.get("n_descriptor_workers")
 
-    _ = compute_descriptors(
-        sdf_file=internal_sdf,
-        excel_out=features_out,
-        output_csv=None,
-        timeout=None,
-        time_per_molecule=time_per_mol,
+    resources = plan_resources(
+        n_cpus=n_cpus,
+        pipelined=chunk_size is not None and delta_state is None,
+        n_geometry_workers=n_geometry_workers,
+        n_descriptor_workers=n_descriptor_workers,
     )
 
-    # Get computed descriptors
-    X_features, info_df = get_descriptors(df=features_out)
-    # X_features, info_df = get_descriptors(internal_df)
+    full_in = mol_in
+    triaged_df = None
+    n_uncertain = None
+    if triage:
+        full_in = f"{mol_tag}_triage_uncertain.sdf"
+        triaged_df, n_uncertain, input_ids = triage_molecules(
+            mol_in=mol_in,
+            uncertain_sdf=full_in,
+            sep=sep,
+            triage_model=triage_model,
+            band=triage_band,
+            threshold=get_threshold(clf_str=clf, sampling_str=sampling, threshold=threshold),
+        )
+        if verbose != 0:
+            n_total = n_uncertain + triaged_df.shape[0]
+            print(f"Triage short-circuited {triaged_df.shape[0]} of {n_total} molecules; "
+                  f"{n_uncertain} go through geometry optimization and PaDEL.")
 
-    # Select descriptors
-    X_features = select_descriptors(df=X_features)
+    if delta_state is not None:
+        result_df = run_delta(
+            mol_in=mol_in,
+            state_file=delta_state,
+            sep=sep,
+            clf=clf,
+            sampling=sampling,
+            threshold=threshold,
+            time_per_mol=time_per_mol,
+            optimizer=optimizer,
+            energy_tol=energy_tol,
+            padel_threads=resources["padel_threads"],
+            predict_threads=resources["predict_threads"],
+            explain=explain,
+            top_k=top_k,
+            verbose=verbose,
+        )
+    elif n_uncertain == 0:
+        result_df = pd.DataFrame(
+            columns=["ID", "B3clf_predicted_probability", "B3clf_predicted_label"]
+        )
+    elif chunk_size is None:
+        # Geometry optimization
+        # Input:
+        # * Either an SDF file with molecular geometries or a text file with SMILES strings
 
-    # Scale descriptors
-    X_features = scale_descriptors(df=X_features)
+        geometry_report = geometry_optimize(
+            input_fname=full_in,
+            output_sdf=internal_sdf,
+            sep=sep,
+            optimizer=optimizer,
+            energy_tol=energy_tol,
+        )
 
-    # Get classifier
-    # clf = get_clf(clf_str=clf, sampling_str=sampling)
+        df_desc = compute_descriptors(
+            sdf_file=internal_sdf,
+            excel_out=features_out if keep_features == "yes" else None,
+            output_csv=None,
+            timeout=None,
+            time_per_molecule=time_per_mol,
+            threads=resources["padel_threads"],
+        )
 
-    # Get classifier
-    result_df = predict_permeability(
-        clf_str=clf,
-        sampling_str=sampling,
-        mol_features=X_features,
-        info_df=info_df,
-        threshold=threshold,
-    )
+        # Get the compact float32 matrix of the descriptors taken by B3clf models
+        X_features, info_df = get_feature_matrix(df=df_desc)
+
+        # Scale descriptors in place
+        X_features = scale_descriptors(df=X_features)
+
+        # Get classifier
+        # clf = get_clf(clf_str=clf, sampling_str=sampling)
+
+        # Get classifier
+        result_df = predict_permeability(
+            clf_str=clf,
+            sampling_str=sampling,
+            mol_features=X_features,
+            info_df=info_df,
+            threshold=threshold,
+            n_jobs=resources["predict_threads"],
+            explain=explain,
+            top_k=top_k,
+        )
+
+        result_df = add_geometry_report(result_df, geometry_report)
+
+        if keep_sdf != "yes":
+            os.remove(internal_sdf)
+    else:
+        result_df = run_pipeline(
+            mol_in=full_in,
+            sep=sep,
+            clf=clf,
+            sampling=sampling,
+            threshold=threshold,
+            time_per_mol=time_per_mol,
+            chunk_size=chunk_size,
+            n_geometry_workers=resources["n_geometry_workers"],
+            n_descriptor_workers=resources["n_descriptor_workers"],
+            padel_threads=resources["padel_threads"],
+            predict_threads=resources["predict_threads"],
+            explain=explain,
+            top_k=top_k,
+            optimizer=optimizer,
+            energy_tol=energy_tol,
+            features_out=features_out if keep_features == "yes" else None,
+            sdf_out=internal_sdf if keep_sdf == "yes" else None,
+        )
+
+    if triage:
+        os.remove(full_in)
+        result_df["B3clf_triaged"] = False
+        result_df = pd.concat([result_df, triaged_df], ignore_index=True)
+        # restore the input order, the stable sort keeps repeated IDs in their order
+        position = {name: idx for idx, name in reversed(list(enumerate(input_ids)))}
+        order = np.argsort(result_df["ID"].map(position).to_numpy(), kind="stable")
+        result_df = result_df.iloc[order].reset_index(drop=True)
 
     # Get classifier
     display_cols = [
@@ -151,19 +332,33 @@ def b3clf(
         "SMILES",
         "B3clf_predicted_probability",
         "B3clf_predicted_label",
+        "B3clf_triage_probability",
+        "B3clf_triaged",
     ]
 
     result_df = result_df[
-        [col for col in result_df.columns.to_list() if col in display_cols]
+        [
+            col
+            for col in result_df.columns.to_list()
+            if col in display_cols
+            or col.startswith("B3clf_top")
+            or col.startswith("B3clf_FF_")
+        ]
     ]
     if verbose != 0:
         print(result_df)
 
     result_df.to_excel(output, index=None, engine="openpyxl")
 
-    if keep_features != "yes":
-        os.remove(features_out)
-    if keep_sdf != "yes":
-        os.remove(internal_sdf)
-
     return result_df
+
+
+async def b3clf_async(mol_in, **kwargs):
+    """Awaitable variant of :func:`b3clf` for callers that already run an event loop.
+
+    The prediction runs in the default executor of the running loop so that the loop stays
+    responsive. All keyword arguments are passed on to :func:`b3clf`, e.g. `chunk_size` to
+    use the pipelined executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(b3clf, mol_in, **kwargs))
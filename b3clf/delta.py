@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Incremental delta scoring against the state of a previous B3clf run.
+
+The state file keeps, for every molecule ID, its canonical SMILES, the unscaled model features
+and the predictions, together with two fingerprints. The pipeline fingerprint covers the
+settings that change geometries or descriptors; when it changes, everything is recomputed.
+The artifact fingerprint covers the model, scaler, thresholds and feature list; when only it
+changes, the stored features are re-predicted without geometry optimization or PaDEL.
+Molecules that fail embedding or PaDEL are stored with their failure status, so they are not
+recomputed until their structure or the pipeline fingerprint changes. As in the other workflows,
+molecules that could not be embedded are reported without a prediction and molecules PaDEL
+failed for are left out.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from importlib import metadata
+
+import numpy as np
+import pandas as pd
+import rdkit
+from joblib import dump, load
+from rdkit import Chem
+
+from .descriptor_padel import compute_descriptors
+from .geometry_opt import geometry_optimize, load_molecules
+from .utils import (
+    get_feature_matrix,
+    get_feature_names,
+    predict_permeability,
+    scale_descriptors,
+)
+
+__all__ = [
+    "artifact_fingerprint",
+    "pipeline_fingerprint",
+    "run_delta",
+]
+
+STATE_VERSION = 2
+
+
+def _sha256(fnames, settings):
+    hasher = hashlib.sha256()
+    for fname in fnames:
+        with open(fname, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(block)
+    hasher.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def artifact_fingerprint(clf, sampling, threshold="none", explain=False, top_k=5):
+    """Fingerprint of the model, scaler, threshold and feature-list artifacts used to predict."""
+    dirname = os.path.dirname(__file__)
+    fnames = [
+        os.path.join(dirname, "pre_trained", "b3clf_{}_{}.joblib".format(clf, sampling)),
+        os.path.join(dirname, "pre_trained", "b3clf_scaler.joblib"),
+        os.path.join(dirname, "data", "B3clf_thresholds.xlsx"),
+        os.path.join(dirname, "feature_list.txt"),
+    ]
+    settings = {"clf": clf, "sampling": sampling, "threshold": threshold,
+                "explain": explain, "top_k": top_k}
+    return _sha256(fnames, settings)
+
+
+def pipeline_fingerprint(**settings):
+    """Fingerprint of the settings that determine geometries and descriptors.
+
+    Besides `settings`, it covers the RDKit version and the padelpy version, which pins the
+    bundled PaDEL-Descriptor release.
+    """
+    try:
+        padelpy_version = metadata.version("padelpy")
+    except metadata.PackageNotFoundError:
+        padelpy_version = None
+    settings = dict(settings, rdkit=rdkit.__version__, padelpy=padelpy_version)
+    return _sha256([], settings)
+
+
+def _compute_features(mols, optimizer, energy_tol, time_per_mol, padel_threads):
+    """Optimize geometries and compute the model features of `mols`, indexed by ID.
+
+    Molecules that could not be embedded have no features and the status "embedding_failed",
+    molecules PaDEL failed for are missing.
+    """
+    with tempfile.TemporaryDirectory(prefix="b3clf_delta_") as workdir:
+        input_sdf = os.path.join(workdir, "delta_input.sdf")
+        opt_sdf = os.path.join(workdir, "delta_optimized_3d.sdf")
+        writer = Chem.SDWriter(input_sdf)
+        for mol in mols:
+            writer.write(mol)
+        writer.close()
+
+        report = geometry_optimize(input_fname=input_sdf,
+                                   output_sdf=opt_sdf,
+                                   optimizer=optimizer,
+                                   energy_tol=energy_tol)
+        df_desc = compute_descriptors(sdf_file=opt_sdf,
+                                      excel_out=None,
+                                      time_per_molecule=time_per_mol,
+                                      threads=padel_threads)
+
+    X, info = get_feature_matrix(df=df_desc)
+    if X.shape[0] == 0:
+        # PaDEL returns no columns at all without molecules
+        X = np.empty((0, len(get_feature_names())), dtype=np.float32)
+    records = pd.DataFrame(X, index=info.index, columns=get_feature_names())
+    records.index.name = "ID"
+    records = records[~records.index.duplicated()]
+    records["B3clf_status"] = "ok"
+    if report is not None:
+        report = report[~report.index.duplicated()]
+        records = records.join(report)
+        not_embedded = report[report["B3clf_FF_status"] == "embedding_failed"].copy()
+        not_embedded["B3clf_status"] = "embedding_failed"
+        records = pd.concat([records, not_embedded])
+    return records
+
+
+def _failed_records(ids, canonical, status):
+    """Records of molecules without features, marked with their failure status."""
+    failed = pd.DataFrame({"canonical_smiles": canonical.reindex(ids).to_numpy()},
+                          index=pd.Index(ids, name="ID"))
+    failed["B3clf_status"] = status
+    return failed
+
+
+def _predict_records(records, clf, sampling, threshold, predict_threads, explain, top_k):
+    """Predict stored records and replace their previous predictions."""
+    feature_names = get_feature_names()
+    X = scale_descriptors(df=np.array(records[feature_names], dtype=np.float32))
+    info_df = pd.DataFrame(index=records.index.rename("ID"))
+    result = predict_permeability(clf_str=clf,
+                                  sampling_str=sampling,
+                                  mol_features=X,
+                                  info_df=info_df,
+                                  threshold=threshold,
+                                  n_jobs=predict_threads,
+                                  explain=explain,
+                                  top_k=top_k).set_index("ID")
+
+    kept_cols = ["canonical_smiles", "B3clf_status"] + feature_names + \
+        [col for col in records.columns if col.startswith("B3clf_FF_")]
+    return records[kept_cols].join(result)
+
+
+def run_delta(mol_in,
+              state_file,
+              sep="\s+|\t+",
+              clf="xgb",
+              sampling="classic_ADASYN",
+              threshold="none",
+              time_per_mol=-1,
+              optimizer="default",
+              energy_tol=None,
+              padel_threads=-1,
+              predict_threads=None,
+              explain=False,
+              top_k=5,
+              verbose=1,
+              ):
+    """Score only new or changed molecules and merge them with the previous results.
+
+    Molecules are matched by ID and canonical SMILES. Molecules whose ID is new or whose
+    structure changed go through geometry optimization, PaDEL and prediction. When the
+    artifact fingerprint differs from the stored one, unchanged molecules are re-predicted from
+    their stored features; otherwise their stored predictions are reused. Molecules that fail
+    embedding (adaptive optimizers) or PaDEL are stored as failed and retried only when their
+    structure or the pipeline fingerprint changes. Like in the other workflows, molecules that
+    could not be embedded are reported with an empty probability and label, and molecules PaDEL
+    failed for are left out of the results. The updated
+    state is written back to `state_file`. Only the first molecule of a repeated ID is scored.
+
+    Parameters
+    ----------
+    mol_in : str
+        Input SMILES (.smi, .csv) or SDF file with the current set of molecules.
+    state_file : str
+        Joblib state file of the previous run. It is created when it does not exist.
+    time_per_mol, optimizer, energy_tol : optional
+        Pipeline settings, part of the pipeline fingerprint.
+    clf, sampling, threshold, explain, top_k : optional
+        Prediction settings, part of the artifact fingerprint.
+    padel_threads, predict_threads : int, optional
+        Thread budget for PaDEL and prediction.
+    verbose : int, optional
+        When not zero, print how many molecules were reused and recomputed.
+
+    Returns
+    -------
+    result_df : pandas.DataFrame
+        Predictions of the molecules of `mol_in`, in input order.
+
+    """
+    current = []
+    seen = set()
+    for mol in load_molecules(mol_in, sep=sep):
+        name = mol.GetProp("_Name")
+        if name not in seen:
+            seen.add(name)
+            current.append(mol)
+    ids = [mol.GetProp("_Name") for mol in current]
+    canonical = pd.Series([Chem.MolToSmiles(Chem.RemoveHs(mol)) for mol in current],
+                          index=pd.Index(ids, name="ID"))
+
+    a_fingerprint = artifact_fingerprint(clf, sampling, threshold, explain=explain, top_k=top_k)
+    p_fingerprint = pipeline_fingerprint(time_per_mol=time_per_mol,
+                                         optimizer=optimizer,
+                                         energy_tol=energy_tol)
+
+    state = load(state_file) if os.path.isfile(state_file) else None
+    if state is not None and (state.get("version") != STATE_VERSION
+                              or state["pipeline_fingerprint"] != p_fingerprint):
+        state = None
+
+    if state is not None:
+        previous = state["records"]
+        stored_smiles = previous["canonical_smiles"].reindex(canonical.index)
+        reuse = (stored_smiles == canonical).to_numpy()
+        reused = previous.loc[canonical.index[reuse]]
+    else:
+        reuse = np.zeros(len(current), dtype=bool)
+        reused = None
+
+    todo = [mol for mol, flag in zip(current, reuse) if not flag]
+    computed = None
+    failed = []
+    if todo:
+        computed = _compute_features(todo, optimizer, energy_tol, time_per_mol, padel_threads)
+        computed.insert(0, "canonical_smiles", canonical.reindex(computed.index))
+        padel_failed = [mol.GetProp("_Name") for mol in todo
+                        if mol.GetProp("_Name") not in computed.index]
+        failed.append(_failed_records(padel_failed, canonical, "descriptors_failed"))
+
+        ok = computed["B3clf_status"] == "ok"
+        failed.append(computed.loc[~ok].drop(columns=get_feature_names()))
+        computed = computed[ok]
+        if len(computed):
+            computed = _predict_records(computed, clf, sampling, threshold, predict_threads,
+                                        explain, top_k)
+
+    repredicted = 0
+    if reused is not None and len(reused) and state["artifact_fingerprint"] != a_fingerprint:
+        reused_ok = reused["B3clf_status"] == "ok"
+        if reused_ok.any():
+            failed.append(reused[~reused_ok])
+            reused = _predict_records(reused[reused_ok], clf, sampling, threshold,
+                                      predict_threads, explain, top_k)
+            repredicted = len(reused)
+
+    parts = [part for part in [reused, computed] + failed if part is not None and len(part)]
+    if parts:
+        records = pd.concat(parts)
+        records = records.loc[[name for name in ids if name in records.index]]
+    else:
+        records = pd.DataFrame(columns=["canonical_smiles", "B3clf_status"] + get_feature_names())
+    records.index.name = "ID"
+
+    dump({"version": STATE_VERSION,
+          "artifact_fingerprint": a_fingerprint,
+          "pipeline_fingerprint": p_fingerprint,
+          "records": records},
+         state_file)
+
+    n_failed = int((records["B3clf_status"] != "ok").sum())
+    if verbose != 0:
+        print(f"Delta scoring: {int(reuse.sum())} molecules unchanged "
+              f"({repredicted} re-predicted), {len(todo)} new or changed, "
+              f"{n_failed} failed.")
+
+    result_df = records[records["B3clf_status"] != "descriptors_failed"]
+    result_df = result_df.drop(columns=["canonical_smiles", "B3clf_status"] + get_feature_names())
+    # failed records leave NaN in the integer columns of the stored state
+    for col in ("B3clf_predicted_label", "B3clf_FF_iterations"):
+        if col in result_df.columns:
+            result_df[col] = result_df[col].astype(
+                "Int64" if result_df[col].isna().any() else int)
+    result_df = result_df.reset_index()
+
+    return result_df
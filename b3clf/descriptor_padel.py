@@ -40,6 +40,7 @@ def compute_descriptors(sdf_file,
                         output_csv=None,
                         timeout=None,
                         time_per_molecule=-1,
+                        threads=-1,
                         ) -> pd.DataFrame:
     """Compute the chemical descriptors with PaDEL.
 
@@ -52,28 +53,40 @@ def compute_descriptors(sdf_file,
     timeout : float
         The maximum time, in seconds, for calculating the descriptors. When set to be None,
         this does not take effect.
+    threads : int, optional
+        Number of threads used by PaDEL. Default=-1, which uses all available processors.
 
     Returns
     -------
     df_desc : pandas.dataframe
-        The computed pandas dataframe of PaDEL descriptors.
+        The computed pandas dataframe of PaDEL descriptors. Empty, without running PaDEL, when
+        `sdf_file` holds no molecules.
 
     """
+    # molecule names, which also index the dataframe
+    suppl = Chem.SDMolSupplier(sdf_file,
+                               sanitize=True,
+                               removeHs=False,
+                               strictParsing=True)
+    mol_names = [mol.GetProp("_Name") for mol in suppl]
+
+    if len(mol_names) == 0:
+        df_desc = pd.DataFrame(index=pd.Index([], name="ID"))
+        if excel_out is not None:
+            df_desc.to_excel(excel_out, engine="openpyxl")
+        return df_desc
+
     desc = from_sdf(sdf_file=sdf_file,
                     output_csv=output_csv,
                     descriptors=True,
                     fingerprints=False,
                     timeout=timeout,
                     maxruntime=time_per_molecule,
+                    threads=threads,
                     )
     df_desc = pd.DataFrame(desc)
 
     # add molecule names to dataframe
-    suppl = Chem.SDMolSupplier(sdf_file,
-                               sanitize=True,
-                               removeHs=False,
-                               strictParsing=True)
-    mol_names = [mol.GetProp("_Name") for mol in suppl]
     df_desc.index = mol_names
     df_desc.index.name = "ID"
 
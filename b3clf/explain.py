@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Per-descriptor explanations of B3clf predictions, computed for the whole batch at once."""
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LogisticRegression
+from sklearn.tree import DecisionTreeClassifier
+
+from .fast_inference import FlatTreeModel
+
+__all__ = [
+    "EXPLAINED_CLFS",
+    "check_explain",
+    "feature_contributions",
+    "top_k_contributions",
+]
+
+# classifiers feature_contributions can explain
+EXPLAINED_CLFS = ["dtree", "logreg", "xgb"]
+
+
+def check_explain(clf_str, top_k):
+    """Reject explanation settings that would only fail after the descriptors are computed."""
+    if clf_str not in EXPLAINED_CLFS:
+        raise ValueError("Explanations are only supported for {}; got {}".format(
+            ", ".join(EXPLAINED_CLFS), clf_str))
+    _check_top_k(top_k)
+
+
+def _check_top_k(top_k):
+    if int(top_k) != top_k or top_k < 1:
+        raise ValueError("top_k must be a positive integer; got {}".format(top_k))
+
+
+def feature_contributions(clf, X):
+    """Compute the contribution of each scaled descriptor to the BBB+ prediction.
+
+    Parameters
+    ----------
+    clf : object
+        Fitted B3clf classifier.
+    X : numpy.ndarray or pandas.DataFrame
+        Scaled descriptors of shape (n_molecules, n_features).
+
+    Returns
+    -------
+    contributions : numpy.ndarray
+        Array of shape (n_molecules, n_features). For "logreg" these are the scaled feature times
+        coefficient products of the logit, for "dtree" the changes of the BBB+ probability along
+        the decision path and for "xgb" the TreeSHAP values of the margin.
+
+    """
+    X = np.asarray(X)
+
+    if isinstance(clf, LogisticRegression):
+        coef = clf.coef_[0]
+        if list(clf.classes_).index(1) == 0:
+            coef = -coef
+        return X * coef
+    elif isinstance(clf, DecisionTreeClassifier):
+        return FlatTreeModel.from_sklearn(None, clf).contributions(X)
+    elif hasattr(clf, "get_booster"):
+        from xgboost import DMatrix
+
+        contribs = clf.get_booster().predict(DMatrix(X),
+                                             pred_contribs=True,
+                                             validate_features=False)
+        # the last column is the bias term
+        return contribs[:, :-1]
+    else:
+        raise ValueError("Explanations are not supported for {}".format(type(clf).__name__))
+
+
+def top_k_contributions(contributions, feature_names, top_k=5):
+    """Pick the `top_k` descriptors with the largest absolute contribution for each molecule.
+
+    Returns
+    -------
+    top_df : pandas.DataFrame
+        Columns "B3clf_top{k}_feature" and "B3clf_top{k}_contribution" for k = 1, ..., top_k,
+        ordered by decreasing absolute contribution.
+
+    """
+    _check_top_k(top_k)
+    n_features = contributions.shape[1]
+    top_k = min(int(top_k), n_features)
+    magnitude = np.abs(contributions)
+    if top_k < n_features:
+        top_idx = np.argpartition(-magnitude, top_k - 1, axis=1)[:, :top_k]
+    else:
+        top_idx = np.tile(np.arange(n_features), (contributions.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(magnitude, top_idx, axis=1), axis=1)
+    top_idx = np.take_along_axis(top_idx, order, axis=1)
+    top_values = np.take_along_axis(contributions, top_idx, axis=1)
+
+    feature_names = np.asarray(feature_names, dtype=object)
+    columns = {}
+    for k in range(top_k):
+        columns["B3clf_top{}_feature".format(k + 1)] = feature_names[top_idx[:, k]]
+        columns["B3clf_top{}_contribution".format(k + 1)] = top_values[:, k]
+
+    return pd.DataFrame(columns)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Fused NumPy inference for the logistic regression and decision tree models.
+
+The exported models take unscaled features, as returned by get_feature_matrix, and fold the
+B3DB Standard Scaler into the model so that no separate scaling pass is needed.
+"""
+
+import os
+
+import numpy as np
+from joblib import dump
+from sklearn.linear_model import LogisticRegression
+from sklearn.tree import DecisionTreeClassifier
+
+from .utils import _load_artifact, get_clf
+
+__all__ = [
+    "FusedLogisticModel",
+    "FlatTreeModel",
+    "export_fast_model",
+]
+
+
+class FusedLogisticModel:
+    """Logistic regression with the Standard Scaler folded into a single weight vector.
+
+    For the scaler z = (x - mean) / scale and the linear model w.z + b, the decision function
+    is (w / scale).x + (b - sum(w * mean / scale)).
+    """
+
+    def __init__(self, coef, intercept):
+        self.coef = np.ascontiguousarray(coef, dtype=np.float64)
+        self.intercept = float(intercept)
+
+    @classmethod
+    def from_sklearn(cls, scaler, clf):
+        """Fold a fitted StandardScaler and binary LogisticRegression into one model."""
+        if clf.coef_.shape[0] != 1:
+            raise ValueError("Only binary logistic regression models are supported.")
+        coef = clf.coef_[0].astype(np.float64)
+        intercept = float(clf.intercept_[0])
+        # the decision function of sklearn is positive for classes_[1]
+        if list(clf.classes_).index(1) == 0:
+            coef, intercept = -coef, -intercept
+
+        mean = scaler.mean_ if scaler.with_mean else np.zeros_like(coef)
+        scale = scaler.scale_ if scaler.with_std else np.ones_like(coef)
+        fused_coef = coef / scale
+        fused_intercept = intercept - np.dot(fused_coef, mean)
+
+        return cls(fused_coef, fused_intercept)
+
+    def decision_function(self, X):
+        """Compute the logit of BBB+ for unscaled features."""
+        return X @ self.coef + self.intercept
+
+    def predict_proba(self, X):
+        """Compute class probabilities for unscaled features, columns ordered as (BBB-, BBB+)."""
+        proba = np.empty((X.shape[0], 2), dtype=np.float64)
+        proba[:, 1] = 1.0 / (1.0 + np.exp(-self.decision_function(X)))
+        proba[:, 0] = 1.0 - proba[:, 1]
+        return proba
+
+
+class FlatTreeModel:
+    """Decision tree stored as flat node arrays and evaluated level by level over the batch."""
+
+    def __init__(self, mean, scale, children_left, children_right, feature, threshold, value):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.children_left = np.asarray(children_left, dtype=np.intp)
+        self.children_right = np.asarray(children_right, dtype=np.intp)
+        self.feature = np.asarray(feature, dtype=np.intp)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        # probability of BBB+ at each node
+        self.value = np.asarray(value, dtype=np.float64)
+
+    @classmethod
+    def from_sklearn(cls, scaler, clf):
+        """Flatten a fitted DecisionTreeClassifier, keeping the scaler for its inputs.
+
+        With `scaler` set to None, the model takes already scaled features.
+        """
+        tree = clf.tree_
+        if tree.n_outputs != 1:
+            raise ValueError("Only single-output decision trees are supported.")
+        value = tree.value[:, 0, :]
+        value = value / value.sum(axis=1, keepdims=True)
+
+        n_features = tree.n_features
+        if scaler is not None and scaler.with_mean:
+            mean = scaler.mean_
+        else:
+            mean = np.zeros(n_features)
+        if scaler is not None and scaler.with_std:
+            scale = scaler.scale_
+        else:
+            scale = np.ones(n_features)
+
+        return cls(mean=mean,
+                   scale=scale,
+                   children_left=tree.children_left,
+                   children_right=tree.children_right,
+                   feature=tree.feature,
+                   threshold=tree.threshold,
+                   value=value[:, list(clf.classes_).index(1)])
+
+    def _scale(self, X):
+        # sklearn trees compare float32 features against float64 thresholds
+        return ((np.asarray(X) - self.mean) / self.scale).astype(np.float32)
+
+    def _traverse(self, X, contributions=None):
+        """Walk all rows down the tree, optionally accumulating per-feature contributions."""
+        Z = self._scale(X)
+        node = np.zeros(Z.shape[0], dtype=np.intp)
+        if self.children_left[0] == -1:
+            return node
+        active = np.arange(Z.shape[0])
+        while active.size:
+            current = node[active]
+            feature = self.feature[current]
+            go_left = Z[active, feature] <= self.threshold[current]
+            child = np.where(go_left,
+                             self.children_left[current],
+                             self.children_right[current])
+            if contributions is not None:
+                # every row appears once per level, so the fancy-indexed update is safe
+                contributions[active, feature] += self.value[child] - self.value[current]
+            node[active] = child
+            active = active[self.children_left[child] != -1]
+        return node
+
+    def apply(self, X):
+        """Return the index of the leaf reached by each row of unscaled features."""
+        return self._traverse(X)
+
+    def predict_proba(self, X):
+        """Compute class probabilities for unscaled features, columns ordered as (BBB-, BBB+)."""
+        proba = np.empty((X.shape[0], 2), dtype=np.float64)
+        proba[:, 1] = self.value[self.apply(X)]
+        proba[:, 0] = 1.0 - proba[:, 1]
+        return proba
+
+    def contributions(self, X):
+        """Per-feature contributions to the BBB+ probability along each decision path.
+
+        The contributions of a row sum to its BBB+ probability minus the root value.
+        """
+        contributions = np.zeros((X.shape[0], self.mean.shape[0]), dtype=np.float64)
+        self._traverse(X, contributions=contributions)
+        return contributions
+
+
+def export_fast_model(clf_str, sampling_str, fname=None):
+    """Export a bundled logreg or dtree model to its fused NumPy representation.
+
+    Parameters
+    ----------
+    clf_str : str
+        Classification algorithm, "logreg" or "dtree".
+    sampling_str : str
+        Sampling strategy of the bundled model.
+    fname : str, optional
+        When given, the exported model is also saved to this joblib file.
+
+    Returns
+    -------
+    model : FusedLogisticModel or FlatTreeModel
+        Model whose `predict_proba` takes unscaled features.
+
+    """
+    dirname = os.path.dirname(__file__)
+    scaler = _load_artifact(os.path.join(dirname, "pre_trained", "b3clf_scaler.joblib"))
+    clf = get_clf(clf_str=clf_str, sampling_str=sampling_str)
+
+    if isinstance(clf, LogisticRegression):
+        model = FusedLogisticModel.from_sklearn(scaler, clf)
+    elif isinstance(clf, DecisionTreeClassifier):
+        model = FlatTreeModel.from_sklearn(scaler, clf)
+    else:
+        raise ValueError("Fast inference is only supported for logreg and dtree; "
+                         "got {}".format(clf_str))
+
+    if fname is not None:
+        dump(model, fname)
+
+    return model
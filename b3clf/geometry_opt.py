@@ -21,12 +21,19 @@
 #
 # --
 
+import numpy as np
 import pandas as pd
 from rdkit import Chem
 from rdkit.Chem import AllChem
+# registers the Snapshot class returned by ForceField.MinimizeTrajectory
+from rdkit.Chem import rdtrajectory  # noqa: F401
 
 """Convert SMILES to 3D and/or minimize the geometry from SDF with force field."""
 
+# convergence criteria (forceTol, energyTol) of the RDKit minimizer for the adaptive optimizers;
+# "adaptive" uses the RDKit defaults
+FF_TOL = {"adaptive": (1.e-4, 1.e-6), "screening": (1.e-2, 1.e-4)}
+
 
 def geometry_optimize(input_fname,
                       output_sdf,
@@ -36,18 +43,26 @@ def geometry_optimize(input_fname,
                       # optimization="cg",
                       force_field="MMFF94s",
                       smi_col=None,
-                      sep="\s+|t+"):
-    """Generate 3D coordinates and run geometry optimization with force field."""
+                      sep="\s+|t+",
+                      optimizer="default",
+                      energy_tol=None):
+    """Generate 3D coordinates and run geometry optimization with force field.
+
+    With the "adaptive" or "screening" optimizer, the per-molecule convergence report of
+    minimize_with_rdkit is returned, otherwise None.
+    """
 
     # optimize the 3d coordinates
     # use RDKit to minimize the geometry
     if tool.lower() == "rdkit":
-        minimize_with_rdkit(input_molfname=input_fname,
-                            sdf_out=output_sdf,
-                            maxIters=steps_opt,
-                            force_field=force_field,
-                            smi_col=smi_col,
-                            sep=sep)
+        return minimize_with_rdkit(input_molfname=input_fname,
+                                   sdf_out=output_sdf,
+                                   maxIters=steps_opt,
+                                   force_field=force_field,
+                                   smi_col=smi_col,
+                                   sep=sep,
+                                   optimizer=optimizer,
+                                   energy_tol=energy_tol)
     # use openbabel to minimize the geometry
     elif tool == "openbabel":
         # minimize_with_openbabel(input_molfname=input_fname,
@@ -62,61 +77,149 @@ def geometry_optimize(input_fname,
         raise ValueError("{} not implemented yet.".format(tool))
 
 
-def minimize_with_rdkit(input_molfname,
-                        sdf_out,
-                        smi_col=None,
-                        mol_name_col=None,
-                        maxIters=400,
-                        force_field="MMFF94s",
-                        sep="\s+"):
-    """Add hydrogen for 3D coordinates and minimize the geometry with RdKit."""
-    # load molecules
+def iter_molecules(input_molfname,
+                   smi_col=None,
+                   mol_name_col=None,
+                   sep="\s+",
+                   block_size=10000):
+    """Stream molecules from a SMILES (.smi/.csv) or SDF file and make sure each one has a name.
+
+    SMILES files are parsed `block_size` lines at a time and SDF files record by record, so
+    only a bounded part of the input is held in memory.
+    """
     if input_molfname.lower().endswith(".smi") or input_molfname.lower().endswith(".csv"):
         # todo: support .txt files
         # todo: add support of more flexible separators
         # todo: fix problem when mol_name is empty
-        df_mol = pd.read_csv(input_molfname, sep=sep, engine="python", header=None)
-        if df_mol.shape[1] == 1:
-            # Case for only SMILES column
-            smile_list = df_mol.iloc[:, -1].to_list()
-            mol_name_list = df_mol.iloc[:, -1].to_list()
-        else:
-            # Case for SMILES and MOL name columns
-            if smi_col is None:
-                smile_list = df_mol.iloc[:, 0].to_list()
-            else:
-                smile_list = df_mol[smi_col].to_list()
-
-            if mol_name_col is None:
-            # todo: use name if column name is valid
+        reader = pd.read_csv(input_molfname, sep=sep, engine="python", header=None,
+                             chunksize=block_size)
+        for df_mol in reader:
+            if df_mol.shape[1] == 1:
+                # Case for only SMILES column
+                smile_list = df_mol.iloc[:, -1].to_list()
                 mol_name_list = df_mol.iloc[:, -1].to_list()
             else:
-                mol_name_list = df_mol[mol_name_col].to_list()
+                # Case for SMILES and MOL name columns
+                if smi_col is None:
+                    smile_list = df_mol.iloc[:, 0].to_list()
+                else:
+                    smile_list = df_mol[smi_col].to_list()
+
+                if mol_name_col is None:
+                    # todo: use name if column name is valid
+                    mol_name_list = df_mol.iloc[:, -1].to_list()
+                else:
+                    mol_name_list = df_mol[mol_name_col].to_list()
 
-        mols = []
-        for idx, smi in enumerate(smile_list):
-            mol = Chem.MolFromSmiles(smi)
-            # This will overwrite
-            if mol is not None:
-                mol.SetProp("_Name", mol_name_list[idx])
-                mols.append(mol)
+            for idx, smi in enumerate(smile_list):
+                mol = Chem.MolFromSmiles(smi)
+                # This will overwrite
+                if mol is not None:
+                    mol.SetProp("_Name", mol_name_list[idx])
+                    yield mol
 
     elif input_molfname.lower().endswith(".sdf"):
         suppl = Chem.SDMolSupplier(input_molfname,
                                    sanitize=True,
                                    removeHs=False,
                                    strictParsing=True)
-        mols = [mol for mol in suppl]
-        for idx, mol in enumerate(mols):
+        for mol in suppl:
+            if mol is None:
+                continue
             if (mol.GetProp("_Name") == "") or (mol.GetProp("_Name") is None):
                 smi = Chem.MolToSmiles(mol)
                 mol.SetProp("_Name", smi)
-                mols[idx] = mol
+            yield mol
+
+    else:
+        raise ValueError("Only SMILES (.smi, .csv) and SDF files are supported; "
+                         "got {}".format(input_molfname))
+
+
+def load_molecules(input_molfname,
+                   smi_col=None,
+                   mol_name_col=None,
+                   sep="\s+"):
+    """Load molecules from a SMILES (.smi/.csv) or SDF file and make sure each one has a name."""
+    return list(iter_molecules(input_molfname,
+                               smi_col=smi_col,
+                               mol_name_col=mol_name_col,
+                               sep=sep))
+
+
+def minimize_with_rdkit(input_molfname,
+                        sdf_out,
+                        smi_col=None,
+                        mol_name_col=None,
+                        maxIters=400,
+                        force_field="MMFF94s",
+                        sep="\s+",
+                        optimizer="default",
+                        energy_tol=None):
+    """Add hydrogen for 3D coordinates and minimize the geometry with RdKit.
+
+    Parameters
+    ----------
+    optimizer : str, optional
+        "default" runs a single RDKit minimization of up to `maxIters` iterations, retried with
+        twice as many iterations when it does not converge. "adaptive" sets up the force field
+        once per molecule and runs a single minimization of up to `maxIters` iterations with
+        the RDKit convergence criteria, recording the iterations used. "screening" does the same
+        with a 100 times looser force and energy tolerance, trading geometry precision for
+        throughput. Molecules that cannot be embedded are left out of `sdf_out`, so they never
+        reach PaDEL, and only appear in the report. Default="default".
+    energy_tol : float, optional
+        Relative energy change per iteration at which the adaptive optimizers stop, the
+        `energyTol` of the RDKit minimizer. Default=None, which uses 1e-6 for "adaptive" and
+        1e-4 for "screening".
+
+    Returns
+    -------
+    report : pandas.DataFrame or None
+        For the adaptive optimizers, the final energy, iterations used, convergence status and
+        force field of each molecule, indexed by molecule name. The same values are stored as
+        SDF properties. None for the "default" optimizer.
+
+    """
+    if optimizer not in ("default", "adaptive", "screening"):
+        raise ValueError("Unknown optimizer; got {}".format(optimizer))
+    if optimizer != "default":
+        force_tol, default_energy_tol = FF_TOL[optimizer]
+        if energy_tol is None:
+            energy_tol = default_energy_tol
+
+    # load molecules
+    mols = load_molecules(input_molfname,
+                          smi_col=smi_col,
+                          mol_name_col=mol_name_col,
+                          sep=sep)
 
+    records = []
     writer = Chem.SDWriter(sdf_out)
     for idx, mol in enumerate(mols):
         mol = Chem.AddHs(mol)
-        if force_field == "MMFF94s":
+        if optimizer != "default":
+            record = {"ID": mol.GetProp("_Name")}
+            if AllChem.EmbedMolecule(mol, randomSeed=999) == -1:
+                # without a 3D geometry there are no meaningful descriptors to predict from
+                record.update(B3clf_FF_energy=np.nan,
+                              B3clf_FF_iterations=0,
+                              B3clf_FF_status="embedding_failed",
+                              B3clf_FF_force_field=None)
+                records.append(record)
+                continue
+            record.update(_minimize_adaptive(mol,
+                                             force_field=force_field,
+                                             max_iters=maxIters,
+                                             force_tol=force_tol,
+                                             energy_tol=energy_tol))
+            records.append(record)
+            mol.SetDoubleProp("B3clf_FF_energy", record["B3clf_FF_energy"])
+            mol.SetIntProp("B3clf_FF_iterations", record["B3clf_FF_iterations"])
+            mol.SetProp("B3clf_FF_status", record["B3clf_FF_status"])
+            writer.write(mol)
+
+        elif force_field == "MMFF94s":
             # use MMFF~ force field if possible
 
             # taken from
@@ -172,6 +275,90 @@ def minimize_with_rdkit(input_molfname,
 
     writer.close()
 
+    if optimizer == "default":
+        return None
+    return pd.DataFrame(records,
+                        columns=["ID", "B3clf_FF_energy", "B3clf_FF_iterations",
+                                 "B3clf_FF_status", "B3clf_FF_force_field"]).set_index("ID")
+
+
+def add_geometry_report(result_df, report):
+    """Join the per-molecule convergence report of minimize_with_rdkit to B3clf results by ID.
+
+    Molecules that could not be embedded have no prediction; they are added with an empty
+    probability and label so that their status is visible, and the rows follow the report order.
+    """
+    if report is None:
+        return result_df
+    report = report[~report.index.duplicated()]
+    result_df = result_df.join(report, on="ID")
+
+    failed = report[(report["B3clf_FF_status"] == "embedding_failed")
+                    & ~report.index.isin(result_df["ID"])]
+    if len(failed) == 0:
+        return result_df
+
+    failed = failed.reset_index()
+    failed["B3clf_predicted_probability"] = np.nan
+    result_df = pd.concat([result_df, failed], ignore_index=True)
+    result_df["B3clf_predicted_label"] = result_df["B3clf_predicted_label"].astype("Int64")
+    # the report lists the molecules in input order
+    position = pd.Series(np.arange(len(report)), index=report.index)
+    order = np.argsort(result_df["ID"].map(position).to_numpy(), kind="stable")
+    return result_df.iloc[order].reset_index(drop=True)
+
+
+def _setup_force_field(mol, force_field):
+    """Set up the requested force field, falling back to the other one like the default mode."""
+    def _mmff():
+        props = AllChem.MMFFGetMoleculeProperties(mol, mmffVariant="MMFF94s")
+        if props is None:
+            return None
+        return AllChem.MMFFGetMoleculeForceField(mol, props)
+
+    def _uff():
+        if not AllChem.UFFHasAllMoleculeParams(mol):
+            return None
+        return AllChem.UFFGetMoleculeForceField(mol)
+
+    if force_field == "MMFF94s":
+        candidates = [("MMFF94s", _mmff), ("uff", _uff)]
+    elif force_field == "uff":
+        candidates = [("uff", _uff), ("MMFF94s", _mmff)]
+    else:
+        raise NotImplementedError("This method is not implemented yet.")
+
+    for name, setup in candidates:
+        ff = setup()
+        if ff is not None:
+            return name, ff
+    return None, None
+
+
+def _minimize_adaptive(mol, force_field, max_iters, force_tol, energy_tol):
+    """Minimize an embedded molecule in a single run and count the iterations it took."""
+    ff_name, ff = _setup_force_field(mol, force_field)
+    if ff is None:
+        return {"B3clf_FF_energy": np.nan,
+                "B3clf_FF_iterations": 0,
+                "B3clf_FF_status": "no_force_field",
+                "B3clf_FF_force_field": None}
+
+    ff.Initialize()
+    # one BFGS run keeps its Hessian estimate throughout; a snapshot is taken every iteration,
+    # which is the only way to get the iteration count from the Python API
+    # 0 optimize converged, 1 more iterations required
+    not_converged, snapshots = ff.MinimizeTrajectory(1,
+                                                     maxIts=max_iters,
+                                                     forceTol=force_tol,
+                                                     energyTol=energy_tol)
+    status = "max_iterations" if not_converged else "converged"
+
+    return {"B3clf_FF_energy": ff.CalcEnergy(),
+            "B3clf_FF_iterations": len(snapshots),
+            "B3clf_FF_status": status,
+            "B3clf_FF_force_field": ff_name}
+
 # todo: now the implementation is not supporting adding molecule name (such as SMILES strings)
 # def minimize_with_openbabel(input_molfname,
 #                             sdf_out,
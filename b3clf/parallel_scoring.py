@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Multi-process scoring of large precomputed descriptor matrices without copying them.
+
+The unscaled float32 feature matrix is memory-mapped from a .npy file (or inherited from the
+parent), the models are loaded once in the parent and inherited by forked workers, and every
+worker writes its probabilities into a shared output array. Only a slice of rows is
+materialized per task, so memory stays roughly constant as the number of workers grows.
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn.tree import DecisionTreeClassifier
+
+from .fast_inference import export_fast_model
+from .resources import available_cpus, set_thread_env
+from .utils import get_clf, get_feature_matrix, get_threshold, scale_descriptors
+
+__all__ = [
+    "save_feature_matrix",
+    "score_feature_matrix",
+]
+
+# state shared with the forked workers
+_WORKER_STATE = {}
+
+
+def save_feature_matrix(df, fname):
+    """Store the unscaled float32 model features of a descriptor table as a .npy file.
+
+    Parameters
+    ----------
+    df : str or pandas.DataFrame
+        Padel descriptors, or the path of a file holding them.
+    fname : str
+        Output .npy file.
+
+    Returns
+    -------
+    info : pandas.DataFrame
+        Molecule information in the row order of the saved matrix.
+
+    """
+    X, info = get_feature_matrix(df)
+    np.save(fname, X)
+    return info
+
+
+def _init_worker():
+    # one thread per worker, the parallelism comes from the processes
+    set_thread_env(1)
+    model = _WORKER_STATE["model"]
+    if hasattr(model, "get_params") and "n_jobs" in model.get_params():
+        model.set_params(n_jobs=1)
+
+
+def _score_rows(bounds):
+    """Score rows [start, stop) of the shared feature matrix into the shared output."""
+    start, stop = bounds
+    features = _WORKER_STATE["features"]
+    model = _WORKER_STATE["model"]
+    if _WORKER_STATE["fused"]:
+        proba = model.predict_proba(features[start:stop])[:, 1]
+    else:
+        X = np.array(features[start:stop], dtype=np.float32)
+        proba = model.predict_proba(scale_descriptors(X))[:, 1]
+    _WORKER_STATE["output"][start:stop] = proba
+
+
+def score_feature_matrix(features,
+                         clf="xgb",
+                         sampling="classic_ADASYN",
+                         threshold="none",
+                         n_workers=None,
+                         rows_per_task=16384,
+                         output=None,
+                         ):
+    """Score an unscaled feature matrix with several processes sharing inputs and models.
+
+    Parameters
+    ----------
+    features : str or numpy.ndarray
+        Unscaled model features of shape (n_molecules, n_features), or a .npy file holding them
+        as written by `save_feature_matrix`. Files are memory-mapped, not loaded.
+    clf : str, optional
+        Classification algorithm. "logreg" and "dtree" use the fused NumPy models. Default="xgb".
+    sampling : str, optional
+        Resampling strategy. Default="classic_ADASYN".
+    threshold : str, optional
+        Threshold for the predicted probability. Default="none".
+    n_workers : int, optional
+        Number of worker processes. Default=None, which uses the available CPUs. Platforms
+        without fork score in the calling process.
+    rows_per_task : int, optional
+        Number of rows each task scores. Default=16384.
+    output : str, optional
+        When given, probabilities are written to this memory-mapped .npy file instead of a
+        shared memory block.
+
+    Returns
+    -------
+    proba : numpy.ndarray
+        Predicted BBB+ probabilities.
+    labels : numpy.ndarray
+        Predicted labels.
+
+    """
+    if isinstance(features, str):
+        features = np.load(features, mmap_mode="r")
+    n_rows = features.shape[0]
+
+    if n_workers is None:
+        n_workers = available_cpus()
+    if "fork" not in multiprocessing.get_all_start_methods():
+        n_workers = 1
+
+    model = get_clf(clf_str=clf, sampling_str=sampling)
+    fused = isinstance(model, (LogisticRegression, DecisionTreeClassifier))
+    if fused:
+        model = export_fast_model(clf_str=clf, sampling_str=sampling)
+
+    shm = None
+    if output is not None:
+        proba = np.lib.format.open_memmap(output, mode="w+", dtype=np.float64, shape=(n_rows,))
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=max(1, n_rows) * 8)
+        proba = np.ndarray((n_rows,), dtype=np.float64, buffer=shm.buf)
+
+    tasks = [(start, min(start + rows_per_task, n_rows))
+             for start in range(0, n_rows, rows_per_task)]
+
+    _WORKER_STATE.update(features=features, model=model, fused=fused, output=proba)
+    try:
+        if n_workers > 1 and len(tasks) > 1:
+            ctx = multiprocessing.get_context("fork")
+            with ctx.Pool(processes=min(n_workers, len(tasks)),
+                          initializer=_init_worker) as pool:
+                for _ in pool.imap_unordered(_score_rows, tasks):
+                    pass
+        else:
+            for task in tasks:
+                _score_rows(task)
+
+        if shm is not None:
+            result = proba.copy()
+        else:
+            proba.flush()
+            result = proba
+    finally:
+        _WORKER_STATE.clear()
+        if shm is not None:
+            del proba
+            shm.close()
+            shm.unlink()
+
+    labels = np.greater_equal(
+        result, get_threshold(clf_str=clf, sampling_str=sampling, threshold=threshold)
+    ).astype(int)
+
+    return result, labels
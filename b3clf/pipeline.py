@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Pipelined execution of the B3clf stages over chunks of molecules.
+
+The input is split into chunks which flow through three stages, geometry optimization,
+PaDEL descriptor calculation and prediction, connected by bounded queues. While PaDEL runs
+on chunk n, the geometry of chunk n+1 is being optimized and chunk n-1 is being predicted.
+A full queue blocks the upstream stage, which keeps the number of chunks in flight bounded.
+"""
+
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from rdkit import Chem
+
+from .descriptor_padel import compute_descriptors
+from .geometry_opt import add_geometry_report, iter_molecules, minimize_with_rdkit
+from .resources import set_thread_env
+from .utils import (
+    get_feature_matrix,
+    predict_permeability,
+    scale_descriptors,
+)
+
+__all__ = [
+    "split_into_chunks",
+    "run_pipeline",
+]
+
+# sentinel telling a stage that its upstream is exhausted
+_STOP = object()
+
+
+def split_into_chunks(mol_in, chunk_size, workdir, sep="\s+|\t+"):
+    """Split the input molecules into SDF files with at most `chunk_size` molecules each.
+
+    The input is streamed, so each chunk is handed out as soon as it is complete and only one
+    chunk is held in memory.
+
+    Parameters
+    ----------
+    mol_in : str
+        Input SMILES (.smi, .csv) or SDF file.
+    chunk_size : int
+        Maximum number of molecules per chunk.
+    workdir : str
+        Directory where the chunk files are written.
+    sep : str, optional
+        Separator used to parse a text file with SMILES strings.
+
+    Yields
+    ------
+    chunk_idx : int
+        Index of the chunk, starting from zero.
+    chunk_sdf : str
+        Path of the SDF file holding the molecules of the chunk.
+
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer; got {}".format(chunk_size))
+
+    chunk_idx = 0
+    n_mols = 0
+    writer = None
+    for mol in iter_molecules(mol_in, sep=sep):
+        if writer is None:
+            chunk_sdf = os.path.join(workdir, "chunk_{:06d}_input.sdf".format(chunk_idx))
+            writer = Chem.SDWriter(chunk_sdf)
+        writer.write(mol)
+        n_mols += 1
+        if n_mols == chunk_size:
+            writer.close()
+            yield chunk_idx, chunk_sdf
+            chunk_idx += 1
+            n_mols = 0
+            writer = None
+
+    if writer is not None:
+        writer.close()
+        yield chunk_idx, chunk_sdf
+
+
+def _optimize_chunk(chunk_sdf, steps_opt, force_field, optimizer, energy_tol):
+    """Geometry stage, run in a worker process."""
+    sdf_out = chunk_sdf.replace("_input.sdf", "_optimized_3d.sdf")
+    report = minimize_with_rdkit(input_molfname=chunk_sdf,
+                                 sdf_out=sdf_out,
+                                 maxIters=steps_opt,
+                                 force_field=force_field,
+                                 optimizer=optimizer,
+                                 energy_tol=energy_tol)
+    return sdf_out, report
+
+
+def _stage_worker(func, in_queue, out_queue, errors):
+    """Apply `func` to every chunk of `in_queue` and pass the result on to `out_queue`."""
+    while True:
+        item = in_queue.get()
+        if item is _STOP:
+            # hand the sentinel on to the sibling workers of this stage
+            in_queue.put(_STOP)
+            return
+        # keep draining after a failure so that no upstream stage blocks forever
+        if errors:
+            continue
+        chunk_idx, payload = item
+        try:
+            out_queue.put((chunk_idx, func(payload)))
+        except BaseException as exc:  # pylint: disable=broad-except
+            errors.append(exc)
+
+
+def _start_stage(func, n_workers, in_queue, out_queue, errors):
+    """Start `n_workers` threads for one stage and signal `out_queue` once all have finished."""
+    workers = [threading.Thread(target=_stage_worker,
+                                args=(func, in_queue, out_queue, errors),
+                                daemon=True)
+               for _ in range(n_workers)]
+    for worker in workers:
+        worker.start()
+
+    def _close():
+        for worker in workers:
+            worker.join()
+        out_queue.put(_STOP)
+
+    closer = threading.Thread(target=_close, daemon=True)
+    closer.start()
+    return closer
+
+
+def run_pipeline(mol_in,
+                 sep="\s+|\t+",
+                 clf="xgb",
+                 sampling="classic_ADASYN",
+                 threshold="none",
+                 time_per_mol=-1,
+                 chunk_size=1000,
+                 n_geometry_workers=1,
+                 n_descriptor_workers=1,
+                 padel_threads=-1,
+                 predict_threads=None,
+                 explain=False,
+                 top_k=5,
+                 queue_size=2,
+                 steps_opt=10000,
+                 force_field="MMFF94s",
+                 optimizer="default",
+                 energy_tol=None,
+                 features_out=None,
+                 sdf_out=None,
+                 ):
+    """Run geometry optimization, descriptor calculation and prediction concurrently on chunks.
+
+    Parameters
+    ----------
+    mol_in : str
+        Input SMILES (.smi, .csv) or SDF file.
+    sep : str, optional
+        Separator used to parse a text file with SMILES strings.
+    clf : str, optional
+        Classification algorithm. Default="xgb".
+    sampling : str, optional
+        Resampling strategy. Default="classic_ADASYN".
+    threshold : str, optional
+        Threshold for the predicted probability. Default="none".
+    time_per_mol : int, optional
+        PaDEL time limit for each molecule in seconds. Default=-1, which means no time limit.
+    chunk_size : int, optional
+        Number of molecules per chunk. Default=1000.
+    n_geometry_workers : int, optional
+        Number of worker processes for geometry optimization. Default=1.
+    n_descriptor_workers : int, optional
+        Number of concurrent PaDEL runs. Default=1.
+    padel_threads : int, optional
+        Number of threads of each PaDEL run. Default=-1, which uses all available processors.
+    predict_threads : int, optional
+        Number of threads used for prediction. Default=None, which does not limit them.
+    explain : bool, optional
+        Whether to add the top contributing descriptors to the predictions. Default=False.
+    top_k : int, optional
+        Number of descriptors reported per molecule when `explain` is True. Default=5.
+    queue_size : int, optional
+        Maximum number of finished chunks waiting in front of each stage. Default=2.
+    steps_opt : int, optional
+        Maximum number of force field iterations. Default=10000.
+    force_field : str, optional
+        Force field used for geometry optimization. Default="MMFF94s".
+    optimizer : str, optional
+        Geometry optimizer, see minimize_with_rdkit. Default="default".
+    energy_tol : float, optional
+        Relative energy change stopping the adaptive optimizers. Default=None.
+    features_out : str, optional
+        When given, the PaDEL descriptors of all chunks are saved to this Excel file.
+    sdf_out : str, optional
+        When given, the optimized geometries of all chunks are saved to this SDF file.
+
+    Returns
+    -------
+    result_df : pandas.DataFrame
+        Predictions of all chunks, in input order.
+
+    """
+    errors = []
+    geometry_queue = queue.Queue(maxsize=queue_size)
+    descriptor_queue = queue.Queue(maxsize=queue_size)
+    prediction_queue = queue.Queue(maxsize=queue_size)
+    result_queue = queue.Queue()
+
+    def _descriptors(payload):
+        opt_sdf, report = payload
+        df_desc = compute_descriptors(sdf_file=opt_sdf,
+                                      excel_out=None,
+                                      output_csv=None,
+                                      timeout=None,
+                                      time_per_molecule=time_per_mol,
+                                      threads=padel_threads)
+        return opt_sdf, report, df_desc
+
+    def _predict(payload):
+        opt_sdf, report, df_desc = payload
+        X_features, info_df = get_feature_matrix(df=df_desc)
+        X_features = scale_descriptors(df=X_features)
+        chunk_result = predict_permeability(clf_str=clf,
+                                            sampling_str=sampling,
+                                            mol_features=X_features,
+                                            info_df=info_df,
+                                            threshold=threshold,
+                                            n_jobs=predict_threads,
+                                            explain=explain,
+                                            top_k=top_k)
+        chunk_result = add_geometry_report(chunk_result, report)
+        return opt_sdf, df_desc if features_out is not None else None, chunk_result
+
+    # spawn rather than fork, the pipeline threads are already running when workers start;
+    # each geometry worker is single threaded
+    with tempfile.TemporaryDirectory(prefix="b3clf_") as workdir, \
+            ProcessPoolExecutor(max_workers=n_geometry_workers,
+                                mp_context=multiprocessing.get_context("spawn"),
+                                initializer=set_thread_env,
+                                initargs=(1,)) as pool:
+
+        def _geometry(chunk_sdf):
+            return pool.submit(_optimize_chunk, chunk_sdf, steps_opt, force_field,
+                               optimizer, energy_tol).result()
+
+        closers = [
+            _start_stage(_geometry, n_geometry_workers, geometry_queue, descriptor_queue, errors),
+            _start_stage(_descriptors, n_descriptor_workers, descriptor_queue, prediction_queue,
+                         errors),
+            _start_stage(_predict, 1, prediction_queue, result_queue, errors),
+        ]
+
+        try:
+            for item in split_into_chunks(mol_in, chunk_size, workdir, sep=sep):
+                if errors:
+                    break
+                geometry_queue.put(item)
+        finally:
+            # always release the stage threads, also when reading the input fails
+            geometry_queue.put(_STOP)
+
+        chunk_results = {}
+        while True:
+            item = result_queue.get()
+            if item is _STOP:
+                break
+            chunk_idx, payload = item
+            chunk_results[chunk_idx] = payload
+        for closer in closers:
+            closer.join()
+
+        if errors:
+            raise errors[0]
+
+        ordered = [chunk_results[idx] for idx in sorted(chunk_results)]
+
+        if sdf_out is not None:
+            with open(sdf_out, "w") as f_out:
+                for opt_sdf, _, _ in ordered:
+                    with open(opt_sdf) as f_in:
+                        f_out.write(f_in.read())
+        if features_out is not None:
+            pd.concat([df_keep for _, df_keep, _ in ordered]).to_excel(features_out,
+                                                                       engine="openpyxl")
+
+    if not ordered:
+        return pd.DataFrame(columns=["ID", "B3clf_predicted_probability",
+                                     "B3clf_predicted_label"])
+
+    result_df = pd.concat([chunk_result for _, _, chunk_result in ordered], ignore_index=True)
+
+    return result_df
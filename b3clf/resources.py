@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""CPU budgeting for the B3clf stages.
+
+RDKit minimization, the PaDEL Java threads and the threaded BLAS/OpenMP/xgboost code used
+for prediction all compete for the same cores. A single CPU count is split here into worker
+processes and per-worker threads for each stage, so that concurrent stages do not
+oversubscribe the host.
+"""
+
+import os
+from contextlib import contextmanager
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+__all__ = [
+    "THREAD_ENV_VARS",
+    "available_cpus",
+    "plan_resources",
+    "set_thread_env",
+    "limit_threads",
+]
+
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+
+def _cgroup_cpu_limit():
+    """Return the CPU quota of the cgroup of this process, or None when it is not limited."""
+    # cgroup v2
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return float(quota) / float(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    # cgroup v1
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus():
+    """Number of CPUs this process may use, honouring CPU affinity and cgroup quotas."""
+    if hasattr(os, "sched_getaffinity"):
+        n_cpus = len(os.sched_getaffinity(0))
+    else:
+        n_cpus = os.cpu_count() or 1
+
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        n_cpus = min(n_cpus, int(limit))
+
+    return max(1, n_cpus)
+
+
+def plan_resources(n_cpus=None, pipelined=False, n_geometry_workers=None,
+                   n_descriptor_workers=None):
+    """Split a CPU budget into worker processes and threads for each stage.
+
+    Parameters
+    ----------
+    n_cpus : int, optional
+        Total number of CPUs B3clf may use. Default=None, which uses `available_cpus()`.
+    pipelined : bool, optional
+        Whether the stages run concurrently on chunks. When False, every stage runs alone and
+        gets the whole budget. Default=False.
+    n_geometry_workers : int, optional
+        Number of geometry optimization processes. Default=None, which uses half of the
+        budget when pipelined.
+    n_descriptor_workers : int, optional
+        Number of concurrent PaDEL runs. Default=None, which uses one.
+
+    Returns
+    -------
+    plan : dict
+        Keys "n_cpus", "n_geometry_workers", "n_descriptor_workers", "padel_threads" and
+        "predict_threads".
+
+    """
+    if n_cpus is None:
+        n_cpus = available_cpus()
+    if n_cpus < 1:
+        raise ValueError("n_cpus must be a positive integer; got {}".format(n_cpus))
+
+    if not pipelined:
+        return {"n_cpus": n_cpus,
+                "n_geometry_workers": 1,
+                "n_descriptor_workers": 1,
+                "padel_threads": n_cpus,
+                "predict_threads": n_cpus}
+
+    if n_geometry_workers is None:
+        n_geometry_workers = max(1, n_cpus // 2)
+    if n_descriptor_workers is None:
+        n_descriptor_workers = 1
+    # geometry workers are single threaded, PaDEL gets the rest and prediction, which is
+    # short compared to the other stages, runs on a single thread next to them
+    padel_threads = max(1, (n_cpus - n_geometry_workers) // n_descriptor_workers)
+
+    return {"n_cpus": n_cpus,
+            "n_geometry_workers": n_geometry_workers,
+            "n_descriptor_workers": n_descriptor_workers,
+            "padel_threads": padel_threads,
+            "predict_threads": 1}
+
+
+def set_thread_env(n_threads):
+    """Limit OpenMP/BLAS threads of the current process and the processes it starts."""
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    # libraries already loaded in this process ignore the environment variables
+    if threadpool_limits is not None:
+        threadpool_limits(limits=n_threads)
+
+
+@contextmanager
+def limit_threads(n_threads):
+    """Temporarily limit the OpenMP/BLAS thread pools of the current process."""
+    if threadpool_limits is None or n_threads is None:
+        yield
+    else:
+        with threadpool_limits(limits=n_threads):
+            yield
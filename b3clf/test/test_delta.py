@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Test incremental delta scoring with PaDEL replaced by a stub."""
+
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+from joblib import load
+from rdkit import Chem
+
+from b3clf import delta
+from b3clf.utils import get_feature_names
+
+MOLECULES = [("CC(C)Cc1ccc(cc1)C(C)C(=O)O", "ibuprofen"),
+             ("CC(C)NCC(O)COc1cccc2ccccc12", "propranolol"),
+             ("CC(=O)Oc1ccccc1C(=O)O", "aspirin")]
+# PaDEL fails for this molecule in the stub
+FAILING_ID = "aspirin"
+
+
+@pytest.fixture
+def padel_calls(monkeypatch):
+    """Replace PaDEL by a stub and record the molecules of every call."""
+    calls = []
+
+    def _fake_padel(sdf_file, excel_out=None, time_per_molecule=-1, threads=-1, **kwargs):
+        names = [mol.GetProp("_Name") for mol in Chem.SDMolSupplier(sdf_file, removeHs=False)]
+        calls.append(names)
+        rows = []
+        for name in names:
+            rng = np.random.default_rng(zlib.crc32(name.encode("utf-8")))
+            row = [str(value) for value in rng.normal(size=len(get_feature_names()))]
+            if name == FAILING_ID:
+                row[0] = ""
+            rows.append(row)
+        return pd.DataFrame(rows, columns=get_feature_names(), index=pd.Index(names, name="ID"))
+
+    monkeypatch.setattr(delta, "compute_descriptors", _fake_padel)
+    return calls
+
+
+def _write_input(tmp_path, molecules):
+    fname = tmp_path / "molecules.smi"
+    fname.write_text("".join("{} {}\n".format(smi, name) for smi, name in molecules))
+    return str(fname)
+
+
+def _run(mol_in, state_file, sampling="common"):
+    return delta.run_delta(mol_in, state_file, clf="logreg", sampling=sampling, verbose=0)
+
+
+def test_delta_scoring(tmp_path, padel_calls):
+    state_file = str(tmp_path / "state.joblib")
+    mol_in = _write_input(tmp_path, MOLECULES)
+
+    # the first run computes everything and creates the state
+    first = _run(mol_in, state_file)
+    assert padel_calls == [["ibuprofen", "propranolol", "aspirin"]]
+    assert first["ID"].to_list() == ["ibuprofen", "propranolol"]
+    records = load(state_file)["records"]
+    assert records.loc[FAILING_ID, "B3clf_status"] == "descriptors_failed"
+
+    # an unchanged rerun reuses everything, the failed molecule included
+    rerun = _run(mol_in, state_file)
+    assert len(padel_calls) == 1
+    pd.testing.assert_frame_equal(rerun, first)
+
+    # a new molecule is the only one computed
+    mol_in = _write_input(tmp_path, MOLECULES + [("CCOC(=O)c1ccccc1", "ethyl_benzoate")])
+    grown = _run(mol_in, state_file)
+    assert padel_calls[1:] == [["ethyl_benzoate"]]
+    assert grown["ID"].to_list() == ["ibuprofen", "propranolol", "ethyl_benzoate"]
+    pd.testing.assert_frame_equal(grown.iloc[:2], first)
+
+    # an artifact change re-predicts the stored features without PaDEL
+    repredicted = _run(mol_in, state_file, sampling="classic_SMOTE")
+    assert len(padel_calls) == 2
+    assert repredicted["ID"].to_list() == grown["ID"].to_list()
+    assert not np.allclose(repredicted["B3clf_predicted_probability"],
+                           grown["B3clf_predicted_probability"])
+    assert load(state_file)["records"].loc[FAILING_ID, "B3clf_status"] == "descriptors_failed"
+
+
+def test_changed_structure_is_recomputed(tmp_path, padel_calls):
+    state_file = str(tmp_path / "state.joblib")
+    _run(_write_input(tmp_path, MOLECULES[:2]), state_file)
+
+    changed = [MOLECULES[0], ("CC(C)NCC(O)COc1ccccc1", "propranolol")]
+    _run(_write_input(tmp_path, changed), state_file)
+
+    assert padel_calls[1:] == [["propranolol"]]
+
+
+def test_pipeline_fingerprint_covers_padelpy(monkeypatch):
+    before = delta.pipeline_fingerprint(optimizer="default")
+    monkeypatch.setattr(delta.metadata, "version", lambda name: "0.0.0")
+
+    assert delta.pipeline_fingerprint(optimizer="default") != before
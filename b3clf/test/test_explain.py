@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Test the explanation settings and the top-k selection of descriptor contributions."""
+
+import numpy as np
+import pytest
+
+from b3clf.b3clf import b3clf
+from b3clf.explain import check_explain, top_k_contributions
+
+
+def test_top_k_contributions_order():
+    contributions = np.array([[0.1, -3.0, 2.0, 0.5],
+                              [1.0, 0.0, -0.2, 4.0]])
+
+    top_df = top_k_contributions(contributions, ["a", "b", "c", "d"], top_k=2)
+
+    assert top_df["B3clf_top1_feature"].to_list() == ["b", "d"]
+    assert top_df["B3clf_top2_feature"].to_list() == ["c", "a"]
+    np.testing.assert_array_equal(top_df["B3clf_top1_contribution"], [-3.0, 4.0])
+
+
+@pytest.mark.parametrize("top_k", [0, -2, 1.5])
+def test_invalid_top_k(top_k):
+    with pytest.raises(ValueError):
+        top_k_contributions(np.ones((2, 3)), ["a", "b", "c"], top_k=top_k)
+    with pytest.raises(ValueError):
+        check_explain("logreg", top_k)
+
+
+def test_knn_rejected_before_any_work(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    with pytest.raises(ValueError, match="knn"):
+        b3clf(str(tmp_path / "not_read.smi"), clf="knn", explain=True)
+    # neither geometry nor descriptor files were written
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Test the fused NumPy models against the scikit-learn models they are exported from."""
+
+import os
+
+import numpy as np
+import pytest
+from sklearn.preprocessing import StandardScaler
+from sklearn.tree import DecisionTreeClassifier
+
+from b3clf.fast_inference import FlatTreeModel, export_fast_model
+from b3clf.utils import _load_artifact, get_clf, get_feature_matrix
+
+SAMPLINGS = [
+    "borderline_SMOTE",
+    "classic_ADASYN",
+    "classic_RandUndersampling",
+    "classic_SMOTE",
+    "kmeans_SMOTE",
+    "common",
+]
+
+
+def _padel_features():
+    """Unscaled model features of the bundled test descriptors."""
+    fname = os.path.join(os.path.dirname(__file__), "test_padel_descriptors.xlsx")
+    X, _ = get_feature_matrix(fname)
+    return X
+
+
+@pytest.mark.parametrize("sampling", SAMPLINGS)
+def test_fused_logreg_matches_sklearn(sampling):
+    # float64 inputs, scikit-learn keeps float32 through the scaler and would round there
+    X = _padel_features().astype(np.float64)
+    scaler = _load_artifact(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                         "pre_trained", "b3clf_scaler.joblib"))
+    expected = get_clf(clf_str="logreg", sampling_str=sampling).predict_proba(
+        scaler.transform(X))
+
+    proba = export_fast_model(clf_str="logreg", sampling_str=sampling).predict_proba(X)
+
+    np.testing.assert_allclose(proba, expected, rtol=0, atol=1e-9)
+
+
+def test_flat_tree_matches_sklearn():
+    # the bundled dtree pickles do not load with recent scikit-learn, so fit a tree here
+    rng = np.random.default_rng(42)
+    X = rng.normal(loc=3.0, scale=2.0, size=(500, 8)).astype(np.float32)
+    y = (X[:, 0] + X[:, 3] * X[:, 5] > 9.0).astype(int)
+    scaler = StandardScaler().fit(X)
+    clf = DecisionTreeClassifier(max_depth=6, random_state=0).fit(scaler.transform(X), y)
+    model = FlatTreeModel.from_sklearn(scaler, clf)
+
+    X_new = rng.normal(loc=3.0, scale=2.0, size=(300, 8)).astype(np.float32)
+    X_scaled = scaler.transform(X_new)
+
+    np.testing.assert_allclose(model.predict_proba(X_new), clf.predict_proba(X_scaled),
+                               rtol=0, atol=1e-12)
+    np.testing.assert_array_equal(model.apply(X_new), clf.apply(X_scaled.astype(np.float32)))
+
+    # the path contributions add up to the probability minus the root value
+    contributions = model.contributions(X_new)
+    np.testing.assert_allclose(contributions.sum(axis=1) + model.value[0],
+                               model.predict_proba(X_new)[:, 1], rtol=0, atol=1e-12)
+
+
+def test_flat_tree_without_scaler():
+    rng = np.random.default_rng(7)
+    X = rng.random((200, 4))
+    y = (X[:, 1] > 0.4).astype(int)
+    clf = DecisionTreeClassifier(max_depth=4, random_state=0).fit(X, y)
+    model = FlatTreeModel.from_sklearn(None, clf)
+
+    np.testing.assert_allclose(model.predict_proba(X), clf.predict_proba(X), rtol=0, atol=1e-12)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Test the adaptive geometry optimizers and their convergence report."""
+
+import numpy as np
+import pandas as pd
+from rdkit import Chem
+
+from b3clf import geometry_opt
+from b3clf.geometry_opt import add_geometry_report, minimize_with_rdkit
+
+
+def _write_smiles(tmp_path):
+    fname = tmp_path / "molecules.smi"
+    fname.write_text("CC(C)Cc1ccc(cc1)C(C)C(=O)O ibuprofen\n"
+                     "CC(C)NCC(O)COc1cccc2ccccc12 propranolol\n")
+    return str(fname)
+
+
+def test_adaptive_report(tmp_path):
+    sdf_out = str(tmp_path / "optimized.sdf")
+
+    report = minimize_with_rdkit(_write_smiles(tmp_path), sdf_out, maxIters=10000,
+                                 optimizer="adaptive")
+
+    assert report.index.to_list() == ["ibuprofen", "propranolol"]
+    assert (report["B3clf_FF_status"] == "converged").all()
+    # the actual iteration counts, not multiples of an increment
+    assert (report["B3clf_FF_iterations"] > 0).all()
+    assert (report["B3clf_FF_iterations"] < 10000).all()
+    mols = list(Chem.SDMolSupplier(sdf_out, removeHs=False))
+    assert [mol.GetIntProp("B3clf_FF_iterations") for mol in mols] == \
+        report["B3clf_FF_iterations"].to_list()
+
+
+def test_embedding_failure_reported_without_prediction(tmp_path, monkeypatch):
+    embed = geometry_opt.AllChem.EmbedMolecule
+
+    def _fail_ibuprofen(mol, randomSeed=-1):
+        if mol.GetProp("_Name") == "ibuprofen":
+            return -1
+        return embed(mol, randomSeed=randomSeed)
+
+    monkeypatch.setattr(geometry_opt.AllChem, "EmbedMolecule", _fail_ibuprofen)
+    sdf_out = str(tmp_path / "optimized.sdf")
+
+    report = minimize_with_rdkit(_write_smiles(tmp_path), sdf_out, maxIters=10000,
+                                 optimizer="screening")
+
+    assert report.loc["ibuprofen", "B3clf_FF_status"] == "embedding_failed"
+    # the molecule never reaches PaDEL
+    names = [mol.GetProp("_Name") for mol in Chem.SDMolSupplier(sdf_out, removeHs=False)]
+    assert names == ["propranolol"]
+
+    result_df = pd.DataFrame({"ID": ["propranolol"],
+                              "B3clf_predicted_probability": [0.9],
+                              "B3clf_predicted_label": [1]})
+    result_df = add_geometry_report(result_df, report)
+
+    assert result_df["ID"].to_list() == ["ibuprofen", "propranolol"]
+    assert np.isnan(result_df.loc[0, "B3clf_predicted_probability"])
+    assert result_df["B3clf_predicted_label"].isna().to_list() == [True, False]
+    assert result_df.loc[1, "B3clf_FF_status"] == "converged"
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Test the chunked pipeline with PaDEL replaced by a stub."""
+
+import os
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+from rdkit import Chem
+
+from b3clf import pipeline
+from b3clf.geometry_opt import load_molecules
+from b3clf.utils import get_feature_names
+
+SMILES_FILE = os.path.join(os.path.dirname(__file__), "test_SMILES.csv")
+SEP = "\s+|\t+"
+# PaDEL fails for this molecule in the stub
+FAILING_ID = "CCC"
+
+
+def _input_ids():
+    return [mol.GetProp("_Name") for mol in load_molecules(SMILES_FILE, sep=SEP)]
+
+
+def _fake_padel(sdf_file, excel_out=None, output_csv=None, timeout=None, time_per_molecule=-1,
+                threads=-1):
+    """Stand-in for compute_descriptors returning padelpy-like string descriptors."""
+    names = [mol.GetProp("_Name") for mol in Chem.SDMolSupplier(sdf_file, removeHs=False)]
+    rows = []
+    for name in names:
+        rng = np.random.default_rng(zlib.crc32(name.encode("utf-8")))
+        row = [str(value) for value in rng.normal(size=len(get_feature_names()))]
+        if name == FAILING_ID:
+            row[0] = ""
+        rows.append(row)
+    # later chunks finish first, the pipeline has to restore the order
+    time.sleep(0.05 * (3 - min(int(os.path.basename(sdf_file)[6:12]), 3)))
+    return pd.DataFrame(rows, columns=get_feature_names(), index=pd.Index(names, name="ID"))
+
+
+def _run(mol_in=SMILES_FILE, timeout=120, **kwargs):
+    """Run the pipeline in a thread so that a hang fails the test instead of blocking it."""
+    outcome = {}
+
+    def _target():
+        try:
+            outcome["result"] = pipeline.run_pipeline(mol_in, sep=SEP, clf="logreg",
+                                                      sampling="common", **kwargs)
+        except Exception as exc:  # pylint: disable=broad-except
+            outcome["error"] = exc
+
+    runner = threading.Thread(target=_target, daemon=True)
+    runner.start()
+    runner.join(timeout)
+    assert not runner.is_alive(), "run_pipeline did not return"
+    return outcome
+
+
+def test_split_into_chunks(tmp_path):
+    chunks = list(pipeline.split_into_chunks(SMILES_FILE, 3, str(tmp_path), sep=SEP))
+
+    assert [idx for idx, _ in chunks] == [0, 1, 2]
+    names = [mol.GetProp("_Name") for _, fname in chunks
+             for mol in Chem.SDMolSupplier(fname, removeHs=False)]
+    assert names == _input_ids()
+
+
+def test_pipeline_keeps_input_order(monkeypatch):
+    monkeypatch.setattr(pipeline, "compute_descriptors", _fake_padel)
+
+    outcome = _run(chunk_size=2, n_descriptor_workers=2)
+
+    assert "error" not in outcome
+    expected = [name for name in _input_ids() if name != FAILING_ID]
+    assert outcome["result"]["ID"].to_list() == expected
+
+
+def test_pipeline_survives_empty_chunk(monkeypatch):
+    # with one molecule per chunk, the chunk of the failing molecule has no rows left
+    monkeypatch.setattr(pipeline, "compute_descriptors", _fake_padel)
+
+    outcome = _run(chunk_size=1)
+
+    assert "error" not in outcome
+    result = outcome["result"]
+    assert result.shape[0] == len(_input_ids()) - 1
+    assert FAILING_ID not in result["ID"].to_list()
+    assert result["B3clf_predicted_probability"].notna().all()
+
+
+def test_pipeline_reports_stage_error(monkeypatch):
+    def _broken_padel(sdf_file, **kwargs):
+        raise RuntimeError("PaDEL crashed")
+
+    monkeypatch.setattr(pipeline, "compute_descriptors", _broken_padel)
+
+    outcome = _run(chunk_size=2, n_descriptor_workers=2)
+
+    assert isinstance(outcome.get("error"), RuntimeError)
+
+
+def test_pipeline_stops_when_input_fails(monkeypatch, tmp_path):
+    monkeypatch.setattr(pipeline, "compute_descriptors", _fake_padel)
+    bad_input = tmp_path / "molecules.txt"
+    bad_input.write_text("CCO ethanol\n")
+
+    outcome = _run(mol_in=str(bad_input))
+
+    assert isinstance(outcome.get("error"), ValueError)
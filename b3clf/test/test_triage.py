@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Test the 2D triage in front of the full B3clf workflow."""
+
+import numpy as np
+import pandas as pd
+from rdkit import Chem
+
+from b3clf.triage import calibrate_triage, triage_molecules
+
+# a small CNS drug and a large, polar peptide-like molecule
+MOLECULES = [("CC(C)NCC(O)COc1cccc2ccccc12", "propranolol"),
+             ("NCC(=O)NC(CO)C(=O)NC(CC(N)=O)C(=O)NC(CCC(N)=O)C(=O)NC(CO)C(=O)O", "peptide"),
+             ("CC(C)Cc1ccc(cc1)C(C)C(=O)O", "ibuprofen")]
+
+
+class _LinearSurrogate:
+    """Surrogate with fixed probabilities for the molecules of MOLECULES."""
+
+    def predict_proba(self, X):
+        proba = np.array([{"propranolol": 0.97, "peptide": 0.01, "ibuprofen": 0.5}[name]
+                          for name in X.index])
+        return np.column_stack([1.0 - proba, proba])
+
+
+def _write_input(tmp_path):
+    fname = tmp_path / "molecules.smi"
+    fname.write_text("".join("{} {}\n".format(smi, name) for smi, name in MOLECULES))
+    return str(fname)
+
+
+def test_rule_model_ignores_band(tmp_path):
+    mol_in = _write_input(tmp_path)
+    uncertain_sdf = str(tmp_path / "uncertain.sdf")
+
+    for band in [(0.05, 0.95), (0.4, 0.6)]:
+        triaged_df, n_uncertain, ids = triage_molecules(mol_in, uncertain_sdf, band=band)
+        assert triaged_df["ID"].to_list() == ["peptide"]
+        assert n_uncertain == 2
+    assert ids == [name for _, name in MOLECULES]
+
+
+def test_triaged_rows_keep_the_b3clf_probability_empty(tmp_path):
+    uncertain_sdf = str(tmp_path / "uncertain.sdf")
+
+    triaged_df, n_uncertain, _ = triage_molecules(_write_input(tmp_path), uncertain_sdf,
+                                                  triage_model=_LinearSurrogate(),
+                                                  threshold=0.5)
+
+    assert triaged_df["ID"].to_list() == ["propranolol", "peptide"]
+    assert triaged_df["B3clf_predicted_probability"].isna().all()
+    np.testing.assert_allclose(triaged_df["B3clf_triage_probability"], [0.97, 0.01])
+    assert triaged_df["B3clf_predicted_label"].to_list() == [1, 0]
+    names = [mol.GetProp("_Name") for mol in Chem.SDMolSupplier(uncertain_sdf)]
+    assert names == ["ibuprofen"] and n_uncertain == 1
+
+
+def test_threshold_beyond_band_keeps_molecule_uncertain(tmp_path):
+    uncertain_sdf = str(tmp_path / "uncertain.sdf")
+
+    triaged_df, _, _ = triage_molecules(_write_input(tmp_path), uncertain_sdf,
+                                        triage_model=_LinearSurrogate(), threshold=0.99)
+
+    # 0.97 is above the band but below the label threshold
+    assert triaged_df["ID"].to_list() == ["peptide"]
+
+
+def test_calibrate_triage_reports_held_out_metrics(tmp_path):
+    smiles = ["C" * n + "O" * (n % 3) for n in range(1, 41)]
+    mol_in = tmp_path / "calibration.smi"
+    mol_in.write_text("".join("{} mol{}\n".format(smi, idx) for idx, smi in enumerate(smiles)))
+    b3clf_output = pd.DataFrame({"ID": ["mol{}".format(idx) for idx in range(40)],
+                                 "B3clf_predicted_label": [int(idx < 20) for idx in range(40)]})
+
+    report = calibrate_triage(str(mol_in), b3clf_output, str(tmp_path / "surrogate.joblib"),
+                              band=(0.2, 0.8))
+
+    assert report["n_molecules"] == 40
+    assert report["n_held_out"] == 10
+    assert 0.0 <= report["triaged_fraction"] <= 1.0
+    assert report["expected_speedup"] >= 1.0
+    assert (tmp_path / "surrogate.joblib").exists()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Test the calibration of the pipeline settings with PaDEL replaced by a stub."""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from rdkit import Chem
+
+from b3clf import tuning
+from b3clf.utils import get_feature_names
+
+SMILES_FILE = os.path.join(os.path.dirname(__file__), "test_SMILES.csv")
+SEP = "\s+|\t+"
+
+
+def test_reservoir_sample_is_uniform_and_ordered():
+    counts = np.zeros(10)
+    for seed in range(2000):
+        sample, n_seen = tuning._reservoir_sample(iter(range(10)), 3,
+                                                  np.random.default_rng(seed))
+        assert n_seen == 10
+        assert sample == sorted(sample)
+        counts[sample] += 1
+    np.testing.assert_allclose(counts / 2000, 0.3, atol=0.05)
+
+    sample, n_seen = tuning._reservoir_sample(iter(range(2)), 5, np.random.default_rng(0))
+    assert (sample, n_seen) == ([0, 1], 2)
+
+
+def test_tune_writes_config(tmp_path, monkeypatch):
+    calls = []
+
+    def _fake_padel(sdf_file, excel_out=None, time_per_molecule=-1, threads=-1, **kwargs):
+        calls.append(time_per_molecule)
+        names = [mol.GetProp("_Name") for mol in Chem.SDMolSupplier(sdf_file, removeHs=False)]
+        return pd.DataFrame(np.ones((len(names), len(get_feature_names()))),
+                            columns=get_feature_names(), index=pd.Index(names, name="ID"))
+
+    monkeypatch.setattr(tuning, "compute_descriptors", _fake_padel)
+    output = str(tmp_path / "b3clf_config.json")
+
+    config = tuning.tune(SMILES_FILE, sep=SEP, clf="logreg", sampling="common", n_sample=4,
+                         n_cpus=4, time_per_mol=30, optimizer="screening", output=output)
+
+    assert calls == [30, 30]
+    assert config["calibration"]["n_sample"] == 4
+    assert config["calibration"]["optimizer"] == "screening"
+    assert 1 <= config["n_geometry_workers"] <= 3
+    assert 1 <= config["chunk_size"] <= 7
+    with open(output) as f:
+        assert json.load(f)["chunk_size"] == config["chunk_size"]
+    assert tuning.load_config(output) == {key: config[key] for key in tuning.CONFIG_KEYS}
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Test the conversion of PaDEL descriptor tables into model feature matrices."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from b3clf.utils import get_feature_matrix, get_feature_names
+
+
+def _padel_frame(dtype):
+    """PaDEL-like table of string descriptors, as returned by padelpy."""
+    names = get_feature_names()
+    df = pd.DataFrame([["0.5"] * len(names) for _ in range(3)],
+                      columns=names,
+                      index=pd.Index(["mol_a", "mol_b", "mol_c"], name="ID"))
+    # a failed descriptor comes back as an empty string
+    df.iloc[1, 3] = ""
+    return df.astype(dtype)
+
+
+@pytest.mark.parametrize("dtype", [object, "string"])
+def test_failed_descriptor_drops_row(dtype):
+    X, info = get_feature_matrix(_padel_frame(dtype))
+
+    assert X.dtype == np.float32
+    assert X.shape == (2, len(get_feature_names()))
+    assert info.index.to_list() == ["mol_a", "mol_c"]
+    np.testing.assert_array_equal(X, 0.5)
+
+
+def test_non_finite_descriptor_drops_row():
+    df = _padel_frame(object).replace("", "0.5").astype(np.float64)
+    df.iloc[2, 0] = np.inf
+
+    X, info = get_feature_matrix(df)
+
+    assert info.index.to_list() == ["mol_a", "mol_b"]
+    assert np.isfinite(X).all()
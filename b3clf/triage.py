@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Cheap 2D triage in front of geometry optimization and PaDEL.
+
+A surrogate model scores every molecule from a handful of RDKit 2D descriptors. Molecules whose
+surrogate probability falls outside the confidence band are labelled directly, only the
+uncertain ones go through the full B3clf workflow. The surrogate probability is reported in its
+own column, the B3clf probability of short-circuited molecules is left empty.
+"""
+
+import numpy as np
+import pandas as pd
+from joblib import dump, load
+from rdkit import Chem
+from rdkit.Chem import Crippen, Descriptors, Lipinski, rdMolDescriptors
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+from .geometry_opt import load_molecules
+
+__all__ = [
+    "TRIAGE_DESCRIPTORS",
+    "RuleTriageModel",
+    "compute_2d_descriptors",
+    "load_triage_model",
+    "calibrate_triage",
+    "triage_molecules",
+]
+
+TRIAGE_DESCRIPTORS = ["TPSA", "MolWt", "NumHDonors", "NumHAcceptors", "MolLogP",
+                      "NumRotatableBonds"]
+
+
+class RuleTriageModel:
+    """Default surrogate which only flags obvious BBB- molecules.
+
+    A molecule violating any of the limits gets a BBB+ probability of 0, every other molecule
+    gets 0.5 and is therefore sent through the full workflow. The limits are well outside the
+    property ranges of CNS-active drugs. As only 0 and 0.5 are produced, the triage band has no
+    effect with this model; it matters for surrogates fit with `calibrate_triage`.
+    """
+
+    def __init__(self, max_tpsa=140.0, max_mw=600.0, max_hbd=5):
+        self.max_tpsa = max_tpsa
+        self.max_mw = max_mw
+        self.max_hbd = max_hbd
+
+    def predict_proba(self, X):
+        """Compute class probabilities from a dataframe of TRIAGE_DESCRIPTORS."""
+        impermeable = ((X["TPSA"].to_numpy() > self.max_tpsa)
+                       | (X["MolWt"].to_numpy() > self.max_mw)
+                       | (X["NumHDonors"].to_numpy() > self.max_hbd))
+        proba = np.full((X.shape[0], 2), 0.5)
+        proba[impermeable] = [1.0, 0.0]
+        return proba
+
+
+def compute_2d_descriptors(mols):
+    """Compute the triage descriptors for a list of RDKit molecules, indexed by molecule name."""
+    rows = [[rdMolDescriptors.CalcTPSA(mol),
+             Descriptors.MolWt(mol),
+             Lipinski.NumHDonors(mol),
+             Lipinski.NumHAcceptors(mol),
+             Crippen.MolLogP(mol),
+             Lipinski.NumRotatableBonds(mol)]
+            for mol in mols]
+    df = pd.DataFrame(rows, columns=TRIAGE_DESCRIPTORS,
+                      index=[mol.GetProp("_Name") for mol in mols])
+    df.index.name = "ID"
+    return df
+
+
+def load_triage_model(triage_model=None):
+    """Load a calibrated triage model from file, or return the default rule-based model."""
+    if triage_model is None:
+        return RuleTriageModel()
+    if isinstance(triage_model, str):
+        return load(triage_model)
+    return triage_model
+
+
+def calibrate_triage(mol_in, b3clf_output, fname, sep="\s+|\t+", band=(0.05, 0.95),
+                     threshold=0.5, test_size=0.25, random_seed=42):
+    """Fit a logistic surrogate on 2D descriptors against existing B3clf predictions.
+
+    The triage rate, the expected speedup and the agreement with the full B3clf labels are
+    measured on a held-out split of the molecules, the saved surrogate is then fit on all of
+    them. This is the only place where they are estimated; `b3clf(triage=True)` does not
+    report them.
+
+    Parameters
+    ----------
+    mol_in : str
+        SMILES or SDF file of the molecules that were predicted with B3clf.
+    b3clf_output : str or pandas.DataFrame
+        B3clf output with "ID" and "B3clf_predicted_label" columns.
+    fname : str
+        Joblib file the calibrated surrogate is saved to.
+    sep : str, optional
+        Separator used to parse a text file with SMILES strings.
+    band : tuple of float, optional
+        Confidence band used to report the expected triage rate and agreement.
+    threshold : float, optional
+        Probability threshold of the B3clf labels, as used by `triage_molecules`. Default=0.5.
+    test_size : float, optional
+        Fraction of the molecules held out for the report. Default=0.25.
+    random_seed : int, optional
+        Seed of the held-out split. Default=42.
+
+    Returns
+    -------
+    report : dict
+        Number of molecules, number held out, fraction of the held-out molecules
+        short-circuited within the band, the resulting speedup of geometry optimization and
+        PaDEL (1 / (1 - fraction), ignoring the cost of the 2D descriptors) and agreement of the
+        short-circuited labels with B3clf.
+
+    """
+    if isinstance(b3clf_output, str):
+        if b3clf_output.lower().endswith(".csv"):
+            b3clf_output = pd.read_csv(b3clf_output)
+        else:
+            b3clf_output = pd.read_excel(b3clf_output, engine="openpyxl")
+    labels = b3clf_output.drop_duplicates("ID").set_index("ID")["B3clf_predicted_label"]
+
+    X = compute_2d_descriptors(load_molecules(mol_in, sep=sep))
+    X = X[X.index.isin(labels.index)]
+    X = X[~X.index.duplicated()]
+    y = labels.loc[X.index].to_numpy()
+
+    # stratify when both labels are frequent enough to appear on each side of the split
+    stratify = y if np.bincount(y, minlength=2).min() >= 2 else None
+    X_train, X_test, y_train, y_test = train_test_split(X, y,
+                                                        test_size=test_size,
+                                                        random_state=random_seed,
+                                                        stratify=stratify)
+
+    model = make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000))
+    model.fit(X_train, y_train)
+    proba = model.predict_proba(X_test)[:, 1]
+    # the same short-circuit rule as triage_molecules
+    permeable = proba >= threshold
+    confident = ((proba <= band[0]) & ~permeable) | ((proba >= band[1]) & permeable)
+    agreement = np.mean(permeable[confident].astype(int) == y_test[confident]) \
+        if confident.any() else float("nan")
+    triaged_fraction = float(confident.mean())
+
+    model.fit(X, y)
+    dump(model, fname)
+
+    return {"n_molecules": int(X.shape[0]),
+            "n_held_out": int(X_test.shape[0]),
+            "triaged_fraction": triaged_fraction,
+            "expected_speedup": 1.0 / (1.0 - triaged_fraction) if triaged_fraction < 1.0
+            else float("inf"),
+            "agreement": float(agreement)}
+
+
+def triage_molecules(mol_in, uncertain_sdf, sep="\s+|\t+", triage_model=None,
+                     band=(0.05, 0.95), threshold=0.5):
+    """Short-circuit confidently classified molecules before the full workflow.
+
+    Parameters
+    ----------
+    mol_in : str
+        Input SMILES or SDF file.
+    uncertain_sdf : str
+        SDF file the molecules inside the confidence band are written to.
+    sep : str, optional
+        Separator used to parse a text file with SMILES strings.
+    triage_model : str or object, optional
+        Calibrated surrogate (or its joblib file) with a `predict_proba` method taking a
+        dataframe of TRIAGE_DESCRIPTORS. Default=None, which uses RuleTriageModel.
+    band : tuple of float, optional
+        Molecules with a surrogate BBB+ probability in (band[0], band[1]) are uncertain.
+        Default=(0.05, 0.95).
+    threshold : float, optional
+        Probability threshold of the B3clf labels. Short-circuited molecules are labelled with
+        it, and molecules outside the band but on the other side of it are uncertain too.
+        Default=0.5.
+
+    Returns
+    -------
+    triaged_df : pandas.DataFrame
+        Labels and surrogate probabilities ("B3clf_triage_probability") of the short-circuited
+        molecules. Their "B3clf_predicted_probability" is NaN.
+    n_uncertain : int
+        Number of molecules written to `uncertain_sdf`.
+    ids : list of str
+        Names of all input molecules, in input order.
+
+    """
+    low, high = band
+    if not 0.0 <= low < high <= 1.0:
+        raise ValueError("Triage band must satisfy 0 <= low < high <= 1; got {}".format(band))
+
+    model = load_triage_model(triage_model)
+    mols = load_molecules(mol_in, sep=sep)
+    proba = model.predict_proba(compute_2d_descriptors(mols))[:, 1]
+    permeable = proba >= threshold
+    confident = ((proba <= low) & ~permeable) | ((proba >= high) & permeable)
+
+    writer = Chem.SDWriter(uncertain_sdf)
+    for mol, is_confident in zip(mols, confident):
+        if not is_confident:
+            writer.write(mol)
+    writer.close()
+
+    ids = [mol.GetProp("_Name") for mol in mols]
+    triaged_df = pd.DataFrame({
+        "ID": [name for name, flag in zip(ids, confident) if flag],
+        "B3clf_predicted_probability": np.nan,
+        "B3clf_predicted_label": permeable[confident].astype(int),
+        "B3clf_triage_probability": proba[confident],
+        "B3clf_triaged": True,
+    })
+
+    return triaged_df, int((~confident).sum()), ids
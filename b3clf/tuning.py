@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# The B3clf library computes the blood-brain barrier (BBB) permeability
+# of organic molecules with resampling strategies.
+#
+# Copyright (C) 2021 The Ayers Lab
+#
+# This file is part of B3clf.
+#
+# B3clf is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# B3clf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+"""Calibration of chunk size and worker counts, and the configuration file storing them.
+
+`tune` times the pipeline stages on a sample of the actual input and writes a JSON file with
+the recommended settings. `b3clf()` and the command-line tool read it automatically for every
+setting that is not given explicitly. The file is looked up in this order: the path in the
+B3CLF_CONFIG environment variable, ./b3clf_config.json and ~/.b3clf/config.json.
+"""
+
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from rdkit import Chem
+
+from .descriptor_padel import compute_descriptors
+from .geometry_opt import iter_molecules, minimize_with_rdkit
+from .resources import available_cpus
+from .utils import get_feature_matrix, predict_permeability, scale_descriptors
+
+__all__ = [
+    "CONFIG_KEYS",
+    "find_config",
+    "load_config",
+    "tune",
+]
+
+CONFIG_KEYS = ["chunk_size", "n_cpus", "n_geometry_workers", "n_descriptor_workers"]
+
+CONFIG_FNAME = "b3clf_config.json"
+
+
+def find_config():
+    """Return the path of the configuration file in use, or None if there is none."""
+    candidates = [os.environ.get("B3CLF_CONFIG"),
+                  CONFIG_FNAME,
+                  os.path.join(os.path.expanduser("~"), ".b3clf", "config.json")]
+    for fname in candidates:
+        if fname and os.path.isfile(fname):
+            return fname
+    return None
+
+
+def load_config(fname=None):
+    """Load the recommended settings from `fname`, or from the default locations when None."""
+    if fname is None:
+        fname = find_config()
+        if fname is None:
+            return {}
+    with open(fname) as f:
+        config = json.load(f)
+    return {key: config[key] for key in CONFIG_KEYS if config.get(key) is not None}
+
+
+def _reservoir_sample(mols, n_sample, rng):
+    """Draw up to `n_sample` molecules uniformly from an iterable in one pass, in input order.
+
+    Returns the sample and the number of molecules seen.
+    """
+    reservoir = []
+    n_seen = 0
+    for mol in mols:
+        if n_seen < n_sample:
+            reservoir.append((n_seen, mol))
+        else:
+            slot = rng.integers(n_seen + 1)
+            if slot < n_sample:
+                reservoir[slot] = (n_seen, mol)
+        n_seen += 1
+    reservoir.sort(key=lambda item: item[0])
+    return [mol for _, mol in reservoir], n_seen
+
+
+def _write_sdf(mols, fname):
+    writer = Chem.SDWriter(fname)
+    for mol in mols:
+        writer.write(mol)
+    writer.close()
+
+
+def tune(mol_in,
+         sep="\s+|\t+",
+         clf="xgb",
+         sampling="classic_ADASYN",
+         n_sample=50,
+         n_cpus=None,
+         target_chunk_seconds=60.0,
+         time_per_mol=-1,
+         optimizer="default",
+         energy_tol=None,
+         output=CONFIG_FNAME,
+         random_seed=42,
+         ):
+    """Time the pipeline stages on a sample of the input and write a recommended configuration.
+
+    Parameters
+    ----------
+    mol_in : str
+        Input SMILES (.smi, .csv) or SDF file the configuration is tuned for. It is streamed
+        once to draw the sample, so large inputs are never loaded as a whole.
+    sep : str, optional
+        Separator used to parse a text file with SMILES strings.
+    clf : str, optional
+        Classification algorithm used for the prediction pass. Default="xgb".
+    sampling : str, optional
+        Resampling strategy used for the prediction pass. Default="classic_ADASYN".
+    n_sample : int, optional
+        Number of molecules drawn from the input for calibration. Default=50.
+    n_cpus : int, optional
+        CPU budget to tune for. Default=None, which uses the CPUs available to the process.
+    target_chunk_seconds : float, optional
+        Approximate wall time of the geometry stage per chunk. Shorter chunks keep the
+        pipeline stages overlapping, longer chunks amortize the PaDEL start-up. Default=60.
+    time_per_mol : int, optional
+        PaDEL time limit for each molecule in seconds. Default=-1.
+    optimizer : str, optional
+        Geometry optimizer of the runs being tuned for, see minimize_with_rdkit.
+        Default="default".
+    energy_tol : float, optional
+        Energy tolerance of the adaptive optimizers. Default=None.
+    output : str, optional
+        JSON file the configuration is written to. Default="b3clf_config.json".
+    random_seed : int, optional
+        Seed for drawing the sample. Default=42.
+
+    Returns
+    -------
+    config : dict
+        Recommended settings and the measured per-molecule stage times.
+
+    """
+    if n_cpus is None:
+        n_cpus = available_cpus()
+
+    rng = np.random.default_rng(random_seed)
+    sample, n_mols = _reservoir_sample(iter_molecules(mol_in, sep=sep), n_sample, rng)
+    if n_mols < 2:
+        raise ValueError("At least two molecules are needed for calibration.")
+
+    with tempfile.TemporaryDirectory(prefix="b3clf_tune_") as workdir:
+        sample_sdf = os.path.join(workdir, "sample.sdf")
+        opt_sdf = os.path.join(workdir, "sample_optimized_3d.sdf")
+        single_sdf = os.path.join(workdir, "single_optimized_3d.sdf")
+        _write_sdf(sample, sample_sdf)
+
+        # geometry optimization runs one molecule at a time in each worker process
+        start = time.perf_counter()
+        minimize_with_rdkit(input_molfname=sample_sdf, sdf_out=opt_sdf, maxIters=10000,
+                            optimizer=optimizer, energy_tol=energy_tol)
+        t_geometry = (time.perf_counter() - start) / len(sample)
+
+        # molecules that could not be embedded never reach PaDEL
+        optimized = list(Chem.SDMolSupplier(opt_sdf, removeHs=False))
+        if len(optimized) < 2:
+            raise ValueError("At least two sampled molecules must be embedded for calibration.")
+
+        # a single-molecule PaDEL run measures the fixed start-up cost of the JVM
+        _write_sdf(optimized[:1], single_sdf)
+        start = time.perf_counter()
+        compute_descriptors(sdf_file=single_sdf, excel_out=None,
+                            time_per_molecule=time_per_mol, threads=1)
+        t_padel_startup = time.perf_counter() - start
+
+        start = time.perf_counter()
+        df_desc = compute_descriptors(sdf_file=opt_sdf, excel_out=None,
+                                      time_per_molecule=time_per_mol, threads=1)
+        t_padel_total = time.perf_counter() - start
+        t_descriptor = max(t_padel_total - t_padel_startup, 0.0) / max(len(optimized) - 1, 1)
+
+        start = time.perf_counter()
+        X_features, info_df = get_feature_matrix(df=df_desc)
+        X_features = scale_descriptors(df=X_features)
+        predict_permeability(clf_str=clf, sampling_str=sampling, mol_features=X_features,
+                             info_df=info_df)
+        t_prediction = (time.perf_counter() - start) / len(sample)
+
+    # balance the throughput of the geometry workers and the PaDEL threads,
+    # n_geometry / t_geometry ~ n_padel_threads / t_descriptor
+    if n_cpus == 1:
+        n_geometry_workers = 1
+    else:
+        share = t_geometry / max(t_geometry + t_descriptor, 1e-12)
+        n_geometry_workers = int(min(max(round(n_cpus * share), 1), n_cpus - 1))
+    padel_threads = max(n_cpus - n_geometry_workers, 1)
+
+    # chunks long enough for the JVM start-up to stay below ~5% of the PaDEL time, but short
+    # enough for the geometry stage to finish a chunk in about target_chunk_seconds
+    min_chunk = 20.0 * t_padel_startup * padel_threads / max(t_descriptor, 1e-12)
+    max_chunk = target_chunk_seconds * n_geometry_workers / max(t_geometry, 1e-12)
+    chunk_size = int(max(min(max(min_chunk, 10.0), max_chunk), 1.0))
+    chunk_size = min(chunk_size, n_mols)
+
+    # a second PaDEL run hides the JVM start-up behind the running one when it is significant
+    padel_chunk_seconds = chunk_size * t_descriptor / padel_threads
+    n_descriptor_workers = 2 if padel_threads >= 2 and \
+        t_padel_startup > 0.1 * padel_chunk_seconds else 1
+
+    config = {
+        "chunk_size": chunk_size,
+        "n_cpus": n_cpus,
+        "n_geometry_workers": n_geometry_workers,
+        "n_descriptor_workers": n_descriptor_workers,
+        "calibration": {
+            "input": os.path.abspath(mol_in),
+            "n_sample": len(sample),
+            "optimizer": optimizer,
+            "geometry_seconds_per_mol": t_geometry,
+            "padel_seconds_per_mol": t_descriptor,
+            "padel_startup_seconds": t_padel_startup,
+            "prediction_seconds_per_mol": t_prediction,
+        },
+    }
+
+    if output is not None:
+        output_dir = os.path.dirname(os.path.abspath(output))
+        os.makedirs(output_dir, exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(config, f, indent=4)
+
+    return config
@@ -24,43 +24,91 @@
 """B3clf utility functions."""
 
 import os
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
 from joblib import load
 
+from .resources import limit_threads
+
 __all__ = [
     "get_descriptors",
+    "get_feature_matrix",
+    "get_feature_names",
     "select_descriptors",
     "scale_descriptors",
     "get_clf",
+    "get_threshold",
     "predict_permeability",
 ]
 
 
+INFO_LIST = ["ID", "compoud_name", "SMILES", "cid", "category", "inchi", "Energy"]
+
+
+@lru_cache(maxsize=None)
+def _load_artifact(fpath):
+    """Load a bundled joblib artifact once per process."""
+    return load(fpath)
+
+
+@lru_cache(maxsize=None)
+def _load_thresholds():
+    """Load the bundled threshold table once per process."""
+    dirname = os.path.dirname(__file__)
+    fpath_thres = os.path.join(dirname, "data", "B3clf_thresholds.xlsx")
+    return pd.read_excel(fpath_thres, index_col=0, engine="openpyxl")
+
+
+@lru_cache(maxsize=None)
+def _load_feature_list():
+    """Load the names of the Padel descriptors taken by B3clf models, in model order."""
+    dirname = os.path.dirname(__file__)
+    with open(os.path.join(dirname, "feature_list.txt")) as f:
+        return tuple(f.read().splitlines())
+
+
+@lru_cache(maxsize=None)
+def _load_feature_set():
+    """Set of the Padel descriptors taken by B3clf models, for fast membership tests."""
+    return frozenset(_load_feature_list())
+
+
+@lru_cache(maxsize=64)
+def _feature_column_index(columns):
+    """Positions of the model features among `columns`, in the same order as select_descriptors."""
+    selected = _load_feature_set()
+    return np.array([idx for idx, col in enumerate(columns) if col in selected], dtype=np.intp)
+
+
+def _read_descriptor_file(fname):
+    """Read a descriptor table from file."""
+    if fname.lower().endswith(".sdf"):
+        df = pd.read_sdf(fname)
+    elif fname.lower().endswith(".xlsx"):
+        df = pd.read_excel(fname, engine="openpyxl")
+    elif fname.lower().endswith(".csv"):
+        df = pd.read_csv(fname)
+    else:
+        raise ValueError(
+            "Command-line tool only supports feature files in .XLSX format"
+        )
+    return df
+
+
 def get_descriptors(df):
     """Create features dataframe and information dataframe from provided path."""
     if type(df) == str:
-        if df.lower().endswith(".sdf"):
-            df = pd.read_sdf(df)
-        elif df.lower().endswith(".xlsx"):
-            df = pd.read_excel(df, engine="openpyxl")
-        elif df.lower().endswith(".csv"):
-            df = pd.read_csv(df)
-        else:
-            raise ValueError(
-                "Command-line tool only supports feature files in .XLSX format"
-            )
-
-    info_list = ["compoud_name", "SMILES", "cid", "category", "inchi", "Energy"]
+        df = _read_descriptor_file(df)
 
     # drop infinity and NaN values
     df.replace([np.inf, -np.inf], np.nan, inplace=True)
     df.dropna(axis=0, inplace=True)
 
-    features_cols = [col for col in df.columns.to_list() if col not in info_list]
+    features_cols = [col for col in df.columns.to_list() if col not in INFO_LIST]
     X = df[features_cols]
-    info_cols = [col for col in df.columns.to_list() if col in info_list]
+    info_cols = [col for col in df.columns.to_list() if col in INFO_LIST]
     if len(info_cols) != 0:
         info = df[info_cols]
     else:
@@ -69,13 +117,61 @@ def get_descriptors(df):
     return X, info
 
 
+def get_feature_matrix(df):
+    """Create a compact float32 feature matrix and information dataframe.
+
+    Only the Padel descriptors taken by B3clf models are converted, column by column, into a
+    C-contiguous float32 array, so the full descriptor table is never copied. Rows with
+    non-finite model features are dropped.
+
+    Parameters
+    ----------
+    df : str or pandas.DataFrame
+        Padel descriptors, or the path of a file holding them.
+
+    Returns
+    -------
+    X : numpy.ndarray
+        Array of shape (n_molecules, n_features) with dtype float32.
+    info : pandas.DataFrame
+        Molecule information, indexed like the rows of `X`.
+
+    """
+    if type(df) == str:
+        df = _read_descriptor_file(df)
+
+    col_index = _feature_column_index(tuple(df.columns.to_list()))
+    X = np.empty((df.shape[0], col_index.shape[0]), dtype=np.float32)
+    for pos, idx in enumerate(col_index):
+        col = df.iloc[:, idx]
+        if not pd.api.types.is_numeric_dtype(col):
+            # padelpy returns strings, object or string dtype depending on pandas, and failed
+            # descriptors are empty strings
+            col = pd.to_numeric(col, errors="coerce")
+        X[:, pos] = col.to_numpy(dtype=np.float64, na_value=np.nan)
+
+    mask = np.isfinite(X).all(axis=1)
+    if not mask.all():
+        X = X[mask]
+
+    info_cols = [col for col in df.columns.to_list() if col in INFO_LIST]
+    if len(info_cols) != 0:
+        info = df.loc[mask, info_cols]
+    else:
+        info = pd.DataFrame(index=df.index[mask])
+
+    return X, info
+
+
+def get_feature_names():
+    """Names of the Padel descriptors taken by B3clf models, in the column order of the models."""
+    return list(_load_feature_list())
+
+
 def select_descriptors(df):
     """Select certain Padel descriptors, which are those taken by B3clf models."""
-    dirname = os.path.dirname(__file__)
-    with open(os.path.join(dirname, "feature_list.txt")) as f:
-        selected_list = f.read().splitlines()
-
-    df_selected = df[[col for col in df.columns.to_list() if col in selected_list]]
+    col_index = _feature_column_index(tuple(df.columns.to_list()))
+    df_selected = df.iloc[:, col_index]
 
     return df_selected
 
@@ -83,12 +179,21 @@ def select_descriptors(df):
 def scale_descriptors(df):
     """Scale input features using B3DB Standard Scaler.
 
-    The b3db_scaler was fitted using the full B3DB dataset.
+    The b3db_scaler was fitted using the full B3DB dataset. A float32 array from
+    get_feature_matrix is scaled in place.
     """
 
     dirname = os.path.dirname(__file__)
     filename = os.path.join(dirname, "pre_trained", "b3clf_scaler.joblib")
-    b3db_scaler = load(filename)
+    b3db_scaler = _load_artifact(filename)
+
+    if isinstance(df, np.ndarray) and df.dtype == np.float32:
+        if b3db_scaler.with_mean:
+            df -= b3db_scaler.mean_
+        if b3db_scaler.with_std:
+            df /= b3db_scaler.scale_
+        return df
+
     df_new = b3db_scaler.transform(df)
 
     return df_new
@@ -120,20 +225,46 @@ def get_clf(clf_str, sampling_str):
         dirname, "pre_trained", "b3clf_{}_{}.joblib".format(clf_str, sampling_str)
     )
 
-    clf = load(clf_path)
+    clf = _load_artifact(clf_path)
 
     return clf
 
 
+def get_threshold(clf_str, sampling_str, threshold="none"):
+    """Get the probability threshold used to assign BBB+ labels."""
+    # load the threshold data
+    df_thres = _load_thresholds()
+    # return df_thres.loc[clf_str + "-" + sampling_str, threshold]
+    return df_thres.loc["xgb-classic_ADASYN", threshold]
+
+
 def predict_permeability(
-    clf_str, sampling_str, mol_features, info_df, threshold="none"
+    clf_str,
+    sampling_str,
+    mol_features,
+    info_df,
+    threshold="none",
+    n_jobs=None,
+    explain=False,
+    top_k=5,
+    feature_names=None,
 ):
-    """Compute and store BBB predicted label and predicted probability to results dataframe."""
+    """Compute and store BBB predicted label and predicted probability to results dataframe.
+
+    When `n_jobs` is given, the classifier and the OpenMP/BLAS thread pools are limited to that
+    many threads. When `explain` is True, the `top_k` descriptors contributing most to each
+    prediction and their contributions are stored next to the probability, see
+    `b3clf.explain.feature_contributions`. `feature_names` defaults to the column names of
+    `mol_features`, or to get_feature_names() for arrays. Without molecules, for instance when
+    PaDEL failed for all of them, an empty result is returned.
+    """
+
+    if mol_features.shape[0] == 0:
+        info_df = info_df.copy()
+        info_df["B3clf_predicted_probability"] = pd.Series(dtype=np.float64)
+        info_df["B3clf_predicted_label"] = pd.Series(dtype=int)
+        return info_df.reset_index()
 
-    # load the threshold data
-    dirname = os.path.dirname(__file__)
-    fpath_thres = os.path.join(dirname, "data", "B3clf_thresholds.xlsx")
-    df_thres = pd.read_excel(fpath_thres, index_col=0, engine="openpyxl")
     # default threshold is 0.5
     label_pool = np.zeros(mol_features.shape[0], dtype=int)
 
@@ -146,20 +277,43 @@ def predict_permeability(
                 "Features_df and Info_df do not have the same index. Internal processing error"
             )
 
-    # get predicted probabilities
-    info_df.loc[:, "B3clf_predicted_probability"] = clf.predict_proba(mol_features)[
-        :, 1
-    ]
+    # the classifier is cached and shared, so its n_jobs is restored after predicting
+    set_n_jobs = n_jobs is not None and "n_jobs" in clf.get_params()
+    if set_n_jobs:
+        previous_n_jobs = clf.get_params()["n_jobs"]
+        clf.set_params(n_jobs=n_jobs)
+    try:
+        # get predicted probabilities
+        with limit_threads(n_jobs):
+            info_df.loc[:, "B3clf_predicted_probability"] = clf.predict_proba(mol_features)[
+                :, 1
+            ]
+    finally:
+        if set_n_jobs:
+            clf.set_params(n_jobs=previous_n_jobs)
     # get predicted label from probability using the threshold
     mask = np.greater_equal(
         info_df["B3clf_predicted_probability"].to_numpy(),
-        # df_thres.loc[clf_str + "-" + sampling_str, threshold])
-        df_thres.loc["xgb-classic_ADASYN", threshold],
+        get_threshold(clf_str=clf_str, sampling_str=sampling_str, threshold=threshold),
     )
     label_pool[mask] = 1
     # save the predicted labels
     info_df["B3clf_predicted_label"] = label_pool
 
+    if explain:
+        # imported here, b3clf.explain builds on the model loaders of this module
+        from .explain import feature_contributions, top_k_contributions
+
+        if feature_names is None:
+            if type(mol_features) == pd.DataFrame:
+                feature_names = mol_features.columns.to_list()
+            else:
+                feature_names = get_feature_names()
+        contributions = feature_contributions(clf, mol_features)
+        top_df = top_k_contributions(contributions, feature_names, top_k=top_k)
+        top_df.index = info_df.index
+        info_df = pd.concat([info_df, top_df], axis=1)
+
     # info_df["B3clf_predicted_label"] = info_df["B3clf_predicted_label"].astype("int64")
     info_df.reset_index(inplace=True)
 